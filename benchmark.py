@@ -0,0 +1,223 @@
+from argparse import ArgumentParser
+import codecs
+import json
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+import warnings
+
+from io_utils.io_utils import IntervalIndex, find_rucoco_files, load_rucoco
+from linguistic_utils.linguistic_utils import initialize_nlp, parse_text, parse_text_as_table
+from linguistic_utils.linguistic_utils import find_token_by_character_index, get_case_and_number, inflect_subphrases
+from metrics_utils.metrics_utils import get_peak_host_memory
+from prepare_dataset import SYSTEM_PROMPT, EXAMPLES, correct_texts, encode_prompt_prefix, load_model
+from substitution_utils.substitution_utils import prepare_sample
+
+
+STAGES: List[str] = ['load', 'parse', 'inflect', 'substitute', 'correct']
+
+
+def measure_stage(stage: str, corpus: str, func: Callable[[], Tuple[int, int]]) -> Dict[str, Any]:
+    start_time = time.perf_counter()
+    n_docs, n_tokens = func()
+    duration = max(time.perf_counter() - start_time, 1e-9)
+    return {
+        'stage': stage,
+        'corpus': corpus,
+        'n_docs': n_docs,
+        'n_tokens': n_tokens,
+        'seconds': duration,
+        'docs_per_sec': n_docs / duration,
+        'tokens_per_sec': n_tokens / duration,
+        'peak_rss_mb': get_peak_host_memory() / (1024.0 * 1024.0)
+    }
+
+
+def make_synthetic_corpus(source_dir: str, target_dir: str, scale: int) -> int:
+    n_files = 0
+    for cur_fname in find_rucoco_files(source_dir):
+        with codecs.open(cur_fname, mode='r', encoding='utf-8') as fp:
+            sample = json.load(fp)
+        # nested mentions are dropped, so every synthetic document passes the validation
+        filled = IntervalIndex()
+        chains = []
+        for cur_chain in sample['entities']:
+            new_chain = list(filter(lambda it: not filled.overlaps(it[0], it[1]), cur_chain))
+            if len(new_chain) < 2:
+                continue
+            for entity_start, entity_end in new_chain:
+                filled.add(entity_start, entity_end)
+            chains.append(new_chain)
+        sample['entities'] = chains
+        base_name = os.path.basename(cur_fname)
+        for copy_idx in range(scale):
+            with codecs.open(os.path.join(target_dir, f'{copy_idx:06d}_{base_name}'), mode='w',
+                             encoding='utf-8') as fp:
+                json.dump(sample, fp, ensure_ascii=False)
+            n_files += 1
+    return n_files
+
+
+def create_tiny_model(model_dir: str):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    texts = [SYSTEM_PROMPT] + [it for example in EXAMPLES for it in example]
+    tokenizer = Tokenizer(models.BPE(unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=1024, special_tokens=['<unk>', '<s>', '<|im_start|>', '<|im_end|>'],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(texts, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token='<unk>', bos_token='<s>',
+                                        eos_token='<|im_end|>')
+    tokenizer.chat_template = ("{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n"
+                               "{% endfor %}{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}")
+    tokenizer.save_pretrained(model_dir)
+    torch.manual_seed(42)
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=32768,
+                         bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    LlamaForCausalLM(config).save_pretrained(model_dir)
+
+
+def run_benchmark(dataset_dir: str, corpus: str, stages: List[str], nlp, morph, tokenizer, model,
+                  device: str, batch_size: int) -> List[Dict[str, Any]]:
+    results = []
+    samples = []
+
+    def load() -> Tuple[int, int]:
+        samples.extend(load_rucoco(dataset_dir))
+        return len(samples), sum(map(lambda it: len(it[0].split()), samples))
+
+    results.append(measure_stage('load', corpus, load))
+
+    if 'parse' in stages:
+        def parse() -> Tuple[int, int]:
+            return len(samples), sum(map(lambda it: len(parse_text(it[0], nlp, morph)), samples))
+
+        results.append(measure_stage('parse', corpus, parse))
+
+    if 'inflect' in stages:
+        parsed = [parse_text_as_table(it[0], nlp, morph) for it in samples]
+
+        def inflect() -> Tuple[int, int]:
+            n_tokens = 0
+            for (text, coreference_chains), (doc, tokens) in zip(samples, parsed):
+                requests = []
+                for cur_chain in coreference_chains:
+                    for entity_start, entity_end in cur_chain:
+                        token_start = find_token_by_character_index(tokens, entity_start)
+                        token_end = find_token_by_character_index(tokens, entity_end - 1) + 1
+                        if (token_start < 0) or (token_end <= token_start):
+                            continue
+                        case, number = get_case_and_number(text, tokens, token_start, token_end, nlp, doc)
+                        requests.append((token_start, token_end, case, number))
+                        n_tokens += token_end - token_start
+                inflect_subphrases(text, tokens, requests, nlp, doc, skip_errors=True)
+            return len(samples), n_tokens
+
+        results.append(measure_stage('inflect', corpus, inflect))
+        del parsed
+
+    prepared = []
+
+    def substitute() -> Tuple[int, int]:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for sample_idx, (text, coreference_chains) in enumerate(samples):
+                prepared_sample = prepare_sample(text, coreference_chains, sample_idx)
+                if prepared_sample is not None:
+                    prepared.append(prepared_sample)
+        return len(prepared), sum(map(lambda it: len(it[1].split()), prepared))
+
+    if ('substitute' in stages) or ('correct' in stages):
+        results.append(measure_stage('substitute', corpus, substitute))
+
+    if 'correct' in stages:
+        prompt_prefix = encode_prompt_prefix(tokenizer, model, device)
+
+        def correct() -> Tuple[int, int]:
+            n_tokens = 0
+            for batch_start in range(0, len(prepared), batch_size):
+                batch = [it[1] for it in prepared[batch_start:(batch_start + batch_size)]]
+                corrected_texts = correct_texts(batch, tokenizer, model, device, prompt_prefix)
+                n_tokens += sum(map(lambda it: len(tokenizer.tokenize(it)), corrected_texts))
+            return len(prepared), n_tokens
+
+        results.append(measure_stage('correct', corpus, correct))
+        del prompt_prefix
+
+    del samples, prepared
+    return results
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', dest='input_name', type=str, required=False,
+                        default=os.path.join(os.path.dirname(__file__), 'tests', 'testdata', 'dataset'),
+                        help='The path to the input RuCoCo.')
+    parser.add_argument('-o', '--output', dest='output_name', type=str, required=False, default='',
+                        help='The path to the JSON file with benchmark results (they are printed if it is empty).')
+    parser.add_argument('-m', '--model', dest='large_language_model', type=str, required=False, default='',
+                        help='The large language model for text correction (a tiny random model if it is empty).')
+    parser.add_argument('--scale', dest='scale', type=int, required=False, default=20,
+                        help='How many times the input corpus is replicated into the synthetic corpus.')
+    parser.add_argument('--stages', dest='stages', type=str, required=False, default=','.join(STAGES),
+                        help=f'The comma-separated list of benchmarked stages from {STAGES}.')
+    parser.add_argument('--device', dest='device', type=str, required=False, default='cpu',
+                        help='The device for the large language model.')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, required=False, default=1,
+                        help='The number of texts which are corrected by the large language model at once.')
+    args = parser.parse_args()
+
+    stages = list(filter(lambda it: len(it) > 0, map(lambda it: it.strip(), args.stages.split(','))))
+    for cur_stage in stages:
+        if cur_stage not in STAGES:
+            raise ValueError(f'The stage "{cur_stage}" is unknown! Expected one of {STAGES}.')
+    if args.scale < 1:
+        raise ValueError(f'The scale is wrong! Expected a positive integer, got {args.scale}.')
+
+    input_dataset_path = os.path.normpath(args.input_name)
+    if ('parse' in stages) or ('inflect' in stages):
+        nlp, morph = initialize_nlp()
+    else:
+        nlp, morph = None, None
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tokenizer, model = None, None
+        if 'correct' in stages:
+            if len(args.large_language_model) > 0:
+                model_path = args.large_language_model
+            else:
+                model_path = os.path.join(temp_dir, 'tiny_model')
+                create_tiny_model(model_path)
+            tokenizer, model = load_model(model_path, args.device)
+        testdata_dir = os.path.join(temp_dir, 'testdata')
+        os.mkdir(testdata_dir)
+        make_synthetic_corpus(input_dataset_path, testdata_dir, 1)
+        results += run_benchmark(testdata_dir, 'testdata', stages, nlp, morph, tokenizer, model, args.device,
+                                 args.batch_size)
+        synthetic_dir = os.path.join(temp_dir, 'synthetic')
+        os.mkdir(synthetic_dir)
+        make_synthetic_corpus(input_dataset_path, synthetic_dir, args.scale)
+        results += run_benchmark(synthetic_dir, 'synthetic', list(filter(lambda it: it != 'correct', stages)),
+                                 nlp, morph, tokenizer, model, args.device, args.batch_size)
+
+    report = {
+        'stages': stages,
+        'scale': args.scale,
+        'results': results
+    }
+    if len(args.output_name) > 0:
+        with codecs.open(os.path.normpath(args.output_name), mode='w', encoding='utf-8') as fp:
+            json.dump(report, fp, ensure_ascii=False, indent=4)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=4))
+
+
+if __name__ == '__main__':
+    main()
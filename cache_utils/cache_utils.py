@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+from threading import Lock
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def calculate_namespace(settings: Dict[str, Any]) -> str:
+    serialized = json.dumps(settings, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def calculate_key(namespace: str, text: str) -> str:
+    return hashlib.sha256((namespace + '\n' + text).encode('utf-8')).hexdigest()
+
+
+class CorrectionCache:
+    """ Persistent content-addressed cache of text corrections in a SQLite database.
+
+    The key of a cached correction is a hash of the namespace and the source text, where the namespace is a hash
+    of everything which the correction depends on (the model, the prompt and the generation settings). If max_entries
+    is positive, then the least recently used corrections are evicted when the cache grows beyond it.
+    """
+
+    def __init__(self, db_fname: str, max_entries: int = 0):
+        if max_entries < 0:
+            raise ValueError(f'The maximal number of cache entries is wrong! Expected a non-negative integer, '
+                             f'got {max_entries}.')
+        base_dir = os.path.dirname(db_fname)
+        if len(base_dir) > 0:
+            if not os.path.isdir(base_dir):
+                raise IOError(f'The directory "{base_dir}" does not exist!')
+        self.db_fname = db_fname
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.n_evicted = 0
+        self._lock = Lock()
+        # the pipelined mode looks up corrections in its generation thread
+        self._connection = sqlite3.connect(db_fname, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS corrections (key TEXT PRIMARY KEY, '
+                                 'corrected_text TEXT NOT NULL, last_access REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS corrections_last_access '
+                                 'ON corrections (last_access)')
+        self._connection.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM corrections').fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        n_lookups = self.hits + self.misses
+        return (self.hits / n_lookups) if n_lookups > 0 else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'evicted': self.n_evicted,
+            'entries': len(self)
+        }
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        found = dict()
+        unique_keys = list(set(keys))
+        with self._lock:
+            for batch_start in range(0, len(unique_keys), 500):
+                batch = unique_keys[batch_start:(batch_start + 500)]
+                query = 'SELECT key, corrected_text FROM corrections WHERE key IN ({})'.format(
+                    ', '.join(['?'] * len(batch))
+                )
+                found.update(self._connection.execute(query, batch).fetchall())
+            if len(found) > 0:
+                access_time = time.time()
+                self._connection.executemany('UPDATE corrections SET last_access = ? WHERE key = ?',
+                                             [(access_time, cur_key) for cur_key in found])
+                self._connection.commit()
+            n_hits = sum(map(lambda it: 1 if it in found else 0, keys))
+            self.hits += n_hits
+            self.misses += len(keys) - n_hits
+        return found
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: List[Tuple[str, str]]):
+        if len(items) == 0:
+            return
+        access_time = time.time()
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO corrections (key, corrected_text, last_access) '
+                                         'VALUES (?, ?, ?)',
+                                         [(cur_key, corrected_text, access_time) for cur_key, corrected_text in items])
+            self._connection.commit()
+        if self.max_entries > 0:
+            self.evict(self.max_entries)
+
+    def put(self, key: str, corrected_text: str):
+        self.put_many([(key, corrected_text)])
+
+    def evict(self, max_entries: int) -> int:
+        with self._lock:
+            n_entries = self._connection.execute('SELECT COUNT(*) FROM corrections').fetchone()[0]
+            n_extra = n_entries - max(max_entries, 0)
+            if n_extra <= 0:
+                return 0
+            self._connection.execute('DELETE FROM corrections WHERE key IN (SELECT key FROM corrections '
+                                     'ORDER BY last_access, rowid LIMIT ?)', (n_extra,))
+            self._connection.commit()
+            self.n_evicted += n_extra
+        return n_extra
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM corrections')
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
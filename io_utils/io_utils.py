@@ -1,10 +1,20 @@
+from bisect import bisect_right
 import codecs
+import csv
+import hashlib
+import heapq
 import json
+from multiprocessing import Pool
 import os
-from typing import List, Tuple
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 import warnings
 
 
+# names of Parquet shards and their spill files, which are written by ParquetDatasetWriter
+SHARD_NAME_RE = re.compile(r'^train-(\d+)\.(parquet|partial\.jsonl)$')
+
+
 def find_entity(bounds_of_entities: List[Tuple[int, int]], char_idx: int) -> int:
     found_idx = -1
     for idx, (start_pos, end_pos) in enumerate(bounds_of_entities):
@@ -14,10 +24,54 @@ def find_entity(bounds_of_entities: List[Tuple[int, int]], char_idx: int) -> int
     return found_idx
 
 
-def load_rucoco(dataset_dir: str) -> List[Tuple[str, List[List[Tuple[int, int]]]]]:
+class IntervalIndex:
+    """ Sorted set of disjoint half-open character intervals [start, end) with logarithmic lookup. """
+
+    def __init__(self, bounds: Optional[List[Tuple[int, int]]] = None):
+        self.starts = []
+        self.ends = []
+        if bounds is not None:
+            for start_pos, end_pos in bounds:
+                self.add(start_pos, end_pos)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def find(self, char_idx: int) -> int:
+        idx = bisect_right(self.starts, char_idx) - 1
+        if (idx >= 0) and (char_idx < self.ends[idx]):
+            return idx
+        return -1
+
+    def overlaps(self, start_pos: int, end_pos: int) -> bool:
+        # intervals are disjoint, so the last one starting before end_pos has the greatest end among the candidates
+        idx = bisect_right(self.starts, end_pos - 1) - 1
+        if idx < 0:
+            return False
+        return self.ends[idx] > start_pos
+
+    def add(self, start_pos: int, end_pos: int) -> bool:
+        if self.overlaps(start_pos, end_pos):
+            return False
+        idx = bisect_right(self.starts, start_pos)
+        self.starts.insert(idx, start_pos)
+        self.ends.insert(idx, end_pos)
+        return True
+
+
+def find_overlapped_interval(bounds: List[Tuple[int, int]]) -> Optional[Tuple[int, int]]:
+    max_end = -1
+    for start_pos, end_pos in sorted(bounds):
+        if start_pos < max_end:
+            return start_pos, end_pos
+        max_end = max(max_end, end_pos)
+    return None
+
+
+def find_rucoco_files(dataset_dir: str) -> List[str]:
     if not os.path.isdir(dataset_dir):
         raise IOError(f'The directory "{dataset_dir}" does not exist!')
-    data_files = list(map(
+    data_files = sorted(map(
         lambda it2: os.path.join(dataset_dir, it2),
         filter(
             lambda it1: it1.lower().endswith('.json'),
@@ -26,77 +80,511 @@ def load_rucoco(dataset_dir: str) -> List[Tuple[str, List[List[Tuple[int, int]]]
     ))
     if len(data_files) == 0:
         raise IOError(f'The directory "{dataset_dir}" is empty!')
-    data_samples = []
-    for cur_fname in data_files:
-        with codecs.open(cur_fname, mode='r', encoding='utf-8') as fp:
-            sample = json.load(fp)
-        err_msg = f'The file "{cur_fname}" contains a wrong data!'
-        if not isinstance(sample, dict):
-            raise IOError(err_msg + f' Expected {type({"a": "b"})}, got {type(sample)}.')
-        if 'text' not in sample:
-            raise IOError(err_msg + f' The "text" field is not found.')
-        if 'entities' not in sample:
-            raise IOError(err_msg + f' The "entities" field is not found.')
-        full_text = sample['text']
-        if not isinstance(full_text, str):
-            err_msg += f' The "text" field is wrong. Expected {type("1")}, got {type(full_text)}.'
-            raise IOError(err_msg)
-        coreference_chains = sample['entities']
-        if not isinstance(coreference_chains, list):
-            err_msg += f' The "entities" field is wrong. Expected {type(["1", "2"])}, got {type(coreference_chains)}.'
+    return data_files
+
+
+def load_rucoco_sample(cur_fname: str) -> Optional[Tuple[str, List[List[Tuple[int, int]]]]]:
+    with codecs.open(cur_fname, mode='r', encoding='utf-8') as fp:
+        sample = json.load(fp)
+    err_msg = f'The file "{cur_fname}" contains a wrong data!'
+    if not isinstance(sample, dict):
+        raise IOError(err_msg + f' Expected {type({"a": "b"})}, got {type(sample)}.')
+    if 'text' not in sample:
+        raise IOError(err_msg + f' The "text" field is not found.')
+    if 'entities' not in sample:
+        raise IOError(err_msg + f' The "entities" field is not found.')
+    full_text = sample['text']
+    if not isinstance(full_text, str):
+        err_msg += f' The "text" field is wrong. Expected {type("1")}, got {type(full_text)}.'
+        raise IOError(err_msg)
+    coreference_chains = sample['entities']
+    if not isinstance(coreference_chains, list):
+        err_msg += f' The "entities" field is wrong. Expected {type(["1", "2"])}, got {type(coreference_chains)}.'
+        raise IOError(err_msg)
+    prepared_coreference_chains = []
+    for cur_chain in coreference_chains:
+        if not isinstance(cur_chain, list):
+            err_msg += f' The "entities" field is wrong.'
             raise IOError(err_msg)
-        prepared_coreference_chains = []
-        for cur_chain in coreference_chains:
-            if not isinstance(cur_chain, list):
+        new_chain = []
+        chain_index = IntervalIndex()
+        for it in cur_chain:
+            if not isinstance(it, list):
                 err_msg += f' The "entities" field is wrong.'
                 raise IOError(err_msg)
-            new_chain = []
-            for it in cur_chain:
-                if not isinstance(it, list):
-                    err_msg += f' The "entities" field is wrong.'
-                    raise IOError(err_msg)
-                if len(it) != 2:
-                    err_msg += f' The "entities" field is wrong.'
-                    raise IOError(err_msg)
-                if (not isinstance(it[0], int)) or (not isinstance(it[1], int)):
-                    err_msg += f' The "entities" field is wrong.'
-                    raise IOError(err_msg)
-                if (it[0] < 0) or (it[1] >= len(full_text)) or (it[0] >= it[1]):
-                    err_msg += f' The "entities" field is wrong.'
-                    raise IOError(err_msg)
-                exists = False
-                for char_idx in range(it[0], it[1]):
-                    if find_entity(new_chain, char_idx) >= 0:
-                        exists = True
-                        break
-                if not exists:
-                    new_chain.append((it[0], it[1]))
-            if len(new_chain) == 0:
+            if len(it) != 2:
                 err_msg += f' The "entities" field is wrong.'
                 raise IOError(err_msg)
-            prepared_coreference_chains.append(sorted(new_chain))
-            del new_chain
-        if len(prepared_coreference_chains) == 0:
-            err_msg += ' The "entities" field is empty.'
+            if (not isinstance(it[0], int)) or (not isinstance(it[1], int)):
+                err_msg += f' The "entities" field is wrong.'
+                raise IOError(err_msg)
+            if (it[0] < 0) or (it[1] >= len(full_text)) or (it[0] >= it[1]):
+                err_msg += f' The "entities" field is wrong.'
+                raise IOError(err_msg)
+            if chain_index.add(it[0], it[1]):
+                new_chain.append((it[0], it[1]))
+        if len(new_chain) == 0:
+            err_msg += f' The "entities" field is wrong.'
             raise IOError(err_msg)
-        filled_chars = [0 for _ in range(len(full_text))]
-        bad_entity = ''
-        for cur_chain in prepared_coreference_chains:
-            for start_char_pos, end_char_pos in cur_chain:
-                for char_idx in range(start_char_pos, end_char_pos):
-                    if filled_chars[char_idx] != 0:
-                        bad_entity = f'{(start_char_pos, end_char_pos)}'
-                        break
-                    filled_chars[char_idx] = 1
-                if len(bad_entity) > 0:
-                    break
-            if len(bad_entity) > 0:
-                break
-        if len(bad_entity) > 0:
-            warn_msg = err_msg +  (f' The "entities" field is wrong. Entity {bad_entity} is overlapped. '
-                                   f'{prepared_coreference_chains}')
-            warnings.warn(warn_msg)
+        prepared_coreference_chains.append(sorted(new_chain))
+        del new_chain, chain_index
+    if len(prepared_coreference_chains) == 0:
+        err_msg += ' The "entities" field is empty.'
+        raise IOError(err_msg)
+    bad_entity = find_overlapped_interval([it for cur_chain in prepared_coreference_chains for it in cur_chain])
+    if bad_entity is not None:
+        warn_msg = err_msg +  (f' The "entities" field is wrong. Entity {bad_entity} is overlapped. '
+                               f'{prepared_coreference_chains}')
+        warnings.warn(warn_msg)
+        return None
+    return full_text, prepared_coreference_chains
+
+
+def iterate_rucoco_files(data_files: List[str], n_processes: int = 1
+                         ) -> Iterator[Optional[Tuple[str, List[List[Tuple[int, int]]]]]]:
+    """ Load samples of the RuCoCo files in their order, and give None for every file with overlapped mentions. """
+    if n_processes > 1:
+        with Pool(processes=n_processes) as pool:
+            yield from pool.imap(load_rucoco_sample, data_files)
+    else:
+        for cur_fname in data_files:
+            yield load_rucoco_sample(cur_fname)
+
+
+def iterate_rucoco(dataset_dir: str, n_processes: int = 1, on_skip: Optional[Callable[[str], None]] = None
+                   ) -> Iterator[Tuple[str, List[List[Tuple[int, int]]]]]:
+    for sample in iterate_rucoco_files(find_rucoco_files(dataset_dir), n_processes):
+        if sample is not None:
+            yield sample
+        elif on_skip is not None:
+            on_skip('overlapped_mentions')
+
+
+def load_rucoco(dataset_dir: str, n_processes: int = 1) -> List[Tuple[str, List[List[Tuple[int, int]]]]]:
+    return list(iterate_rucoco(dataset_dir, n_processes))
+
+
+def load_progress(manifest_fname: str) -> Dict[str, Any]:
+    if not os.path.isfile(manifest_fname):
+        return dict()
+    with codecs.open(manifest_fname, mode='r', encoding='utf-8') as fp:
+        progress = json.load(fp)
+    if not isinstance(progress, dict):
+        raise IOError(f'The file "{manifest_fname}" contains a wrong data! '
+                      f'Expected {type({"a": "b"})}, got {type(progress)}.')
+    return progress
+
+
+def save_progress(manifest_fname: str, progress: Dict[str, Any]):
+    tmp_fname = manifest_fname + '.tmp'
+    with codecs.open(tmp_fname, mode='w', encoding='utf-8') as fp:
+        json.dump(progress, fp, ensure_ascii=False, indent=4)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_fname, manifest_fname)
+
+
+def calculate_file_hash(fname: str, chunk_size: int = 1 << 20) -> str:
+    file_hash = hashlib.sha256()
+    with open(fname, mode='rb') as fp:
+        chunk = fp.read(chunk_size)
+        while len(chunk) > 0:
+            file_hash.update(chunk)
+            chunk = fp.read(chunk_size)
+    return file_hash.hexdigest()
+
+
+def update_file_manifest(data_files: List[str], files: Dict[str, Dict[str, Any]]
+                         ) -> Tuple[Dict[str, Dict[str, Any]], List[Tuple[str, Dict[str, Any]]], List[str]]:
+    """ Compare input files with their entries in the manifest of files, which are keyed by base names of files.
+
+    A file is unchanged if its size and modification time are the same as in the manifest, or else if its content
+    hash is the same. Entries of unchanged files, new entries of added or changed files with their full names,
+    and base names of deleted files are returned.
+    """
+    unchanged_files = dict()
+    new_files = []
+    for cur_fname in data_files:
+        base_name = os.path.basename(cur_fname)
+        file_stat = os.stat(cur_fname)
+        old_entry = files.get(base_name)
+        if (old_entry is not None) and (old_entry['size'] == file_stat.st_size) and \
+                (old_entry['mtime_ns'] == file_stat.st_mtime_ns):
+            unchanged_files[base_name] = old_entry
+            continue
+        new_entry = {
+            'size': file_stat.st_size,
+            'mtime_ns': file_stat.st_mtime_ns,
+            'sha256': calculate_file_hash(cur_fname)
+        }
+        if (old_entry is not None) and (old_entry['sha256'] == new_entry['sha256']):
+            new_entry['n_rows'] = old_entry['n_rows']
+            unchanged_files[base_name] = new_entry
+        else:
+            new_files.append((cur_fname, new_entry))
+    current_names = set(map(os.path.basename, data_files))
+    deleted_names = sorted(filter(lambda it: it not in current_names, files.keys()))
+    return unchanged_files, new_files, deleted_names
+
+
+def save_substitution_plans(fname: str,
+                            plans: Iterable[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]]) -> int:
+    n_plans = 0
+    with codecs.open(fname, mode='w', encoding='utf-8') as fp:
+        for sample_idx, source_text, text_with_substitutions, substitutions in plans:
+            record = {
+                'sample_idx': sample_idx,
+                'source_text': source_text,
+                'text_with_substitutions': text_with_substitutions,
+                'substitutions': [list(it) for it in substitutions]
+            }
+            fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+            n_plans += 1
+    return n_plans
+
+
+def iterate_substitution_plans(fname: str) -> Iterator[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]]:
+    if not os.path.isfile(fname):
+        raise IOError(f'The file "{fname}" does not exist!')
+    with codecs.open(fname, mode='r', encoding='utf-8') as fp:
+        for line_idx, cur_line in enumerate(fp):
+            prep_line = cur_line.strip()
+            if len(prep_line) == 0:
+                continue
+            record = json.loads(prep_line)
+            err_msg = f'The file "{fname}" contains a wrong data in the line {line_idx + 1}!'
+            if not isinstance(record, dict):
+                raise IOError(err_msg + f' Expected {type({"a": "b"})}, got {type(record)}.')
+            for field_name in ['sample_idx', 'source_text', 'text_with_substitutions', 'substitutions']:
+                if field_name not in record:
+                    raise IOError(err_msg + f' The "{field_name}" field is not found.')
+            yield (record['sample_idx'], record['source_text'], record['text_with_substitutions'],
+                   [tuple(it) for it in record['substitutions']])
+
+
+class DatasetWriter:
+    """ Base class of writers of the output dataset, which can continue an interrupted writing.
+
+    Every row is a dictionary with the sample_idx, source_text, text_with_substitutions, n_substitutions and
+    text_without_coreference fields. The write method returns True when all rows written so far are stored durably,
+    and then the state property describes a checkpoint from which the writing can be resumed.
+    """
+
+    def __init__(self, output_dir: str, state: Optional[Dict[str, Any]] = None):
+        self.output_dir = output_dir
+        self.n_rows = 0 if state is None else state['n_rows']
+        self.processed_samples = 0 if state is None else state['processed_samples']
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        return {'n_rows': self.n_rows, 'processed_samples': self.processed_samples}
+
+    def write(self, rows: List[Dict[str, Any]]) -> bool:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CSVDatasetWriter(DatasetWriter):
+    """ Writer of the train_data.csv file with the source_text and text_without_coreference columns.
+
+    If with_sample_idx is True, then the sample_idx column is written too, so that datasets written by several
+    workers can be merged in the original order of samples.
+    """
+
+    def __init__(self, output_dir: str, state: Optional[Dict[str, Any]] = None, with_sample_idx: bool = False):
+        super().__init__(output_dir, state)
+        self.output_fname = os.path.join(output_dir, 'train_data.csv')
+        self.columns = ['source_text', 'text_without_coreference']
+        if with_sample_idx:
+            self.columns.insert(0, 'sample_idx')
+        self.output_size = 0 if state is None else state['output_size']
+        if self.output_size > 0:
+            # the rows written after the last checkpoint are dropped, because their samples will be corrected again
+            os.truncate(self.output_fname, self.output_size)
+            self.fp = open(self.output_fname, mode='a', encoding='utf-8', newline='')
+            self.data_writer = csv.writer(self.fp, delimiter=',', quotechar='"')
+        else:
+            self.fp = open(self.output_fname, mode='w', encoding='utf-8', newline='')
+            self.data_writer = csv.writer(self.fp, delimiter=',', quotechar='"')
+            self.data_writer.writerow(self.columns)
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        res = super().state
+        res['output_size'] = self.output_size
+        return res
+
+    def write(self, rows: List[Dict[str, Any]]) -> bool:
+        if len(rows) == 0:
+            return False
+        self.data_writer.writerows([[it[column] for column in self.columns] for it in rows])
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.output_size = os.fstat(self.fp.fileno()).st_size
+        self.n_rows += len(rows)
+        self.processed_samples = rows[-1]['sample_idx'] + 1
+        return True
+
+    def close(self):
+        self.fp.close()
+
+
+def get_parquet_schema():
+    import pyarrow
+
+    return pyarrow.schema([
+        ('sample_idx', pyarrow.int64()),
+        ('source_text', pyarrow.string()),
+        ('text_with_substitutions', pyarrow.string()),
+        ('n_substitutions', pyarrow.int64()),
+        ('text_without_coreference', pyarrow.string())
+    ])
+
+
+class ParquetDatasetWriter(DatasetWriter):
+    """ Writer of the train-NNNNN.parquet shards, which can be loaded with the Hugging Face datasets library.
+
+    Rows of the current shard are buffered in memory, and every shard is written at once when rows_per_shard rows are
+    accumulated. Until then, every written batch is appended to the train-NNNNN.partial.jsonl spill file of the shard,
+    so it is stored durably and the writing can be resumed from it.
+    """
+
+    def __init__(self, output_dir: str, state: Optional[Dict[str, Any]] = None, rows_per_shard: int = 10000):
+        super().__init__(output_dir, state)
+        if rows_per_shard < 1:
+            raise ValueError(f'The number of rows per shard is wrong! Expected a positive integer, '
+                             f'got {rows_per_shard}.')
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('The pyarrow package is required for the Parquet output.')
+        self.rows_per_shard = rows_per_shard
+        self.n_shards = 0 if state is None else state['n_shards']
+        self.spill_size = 0 if state is None else state.get('spill_size', 0)
+        self.buffer = self.recover_buffer()
+        spill_fname = self.get_spill_name(self.n_shards)
+        with codecs.open(spill_fname + '.tmp', mode='w', encoding='utf-8') as fp:
+            for cur_row in self.buffer:
+                fp.write(json.dumps(cur_row, ensure_ascii=False) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(spill_fname + '.tmp', spill_fname)
+        for cur_fname in os.listdir(output_dir):
+            # the shards and spill files written after the last checkpoint are dropped, because their samples
+            # will be corrected again
+            shard_match = SHARD_NAME_RE.match(cur_fname)
+            if shard_match is not None:
+                shard_idx = int(shard_match.group(1))
+                if shard_match.group(2) == 'parquet':
+                    is_checkpointed = (shard_idx < self.n_shards)
+                else:
+                    is_checkpointed = (shard_idx == self.n_shards)
+                if not is_checkpointed:
+                    os.remove(os.path.join(output_dir, cur_fname))
+        self.spill_fp = open(spill_fname, mode='a', encoding='utf-8')
+        self.spill_size = os.fstat(self.spill_fp.fileno()).st_size
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        res = super().state
+        res['n_shards'] = self.n_shards
+        res['spill_size'] = self.spill_size
+        return res
+
+    def get_shard_name(self, shard_idx: int) -> str:
+        return os.path.join(self.output_dir, f'train-{shard_idx:05d}.parquet')
+
+    def get_spill_name(self, shard_idx: int) -> str:
+        return os.path.join(self.output_dir, f'train-{shard_idx:05d}.partial.jsonl')
+
+    def recover_buffer(self) -> List[Dict[str, Any]]:
+        if self.spill_size == 0:
+            return []
+        spill_fname = self.get_spill_name(self.n_shards)
+        if os.path.isfile(spill_fname):
+            # the rows spilled after the last checkpoint are dropped
+            os.truncate(spill_fname, self.spill_size)
+            with codecs.open(spill_fname, mode='r', encoding='utf-8') as fp:
+                return [json.loads(it) for it in fp if len(it.strip()) > 0]
+        # the spill file is removed after its shard is written, so the checkpointed rows are in the shard
+        import pyarrow.parquet
+
+        shard_fname = self.get_shard_name(self.n_shards)
+        if not os.path.isfile(shard_fname):
+            raise IOError(f'The rows of the shard {self.n_shards} are not found in "{self.output_dir}"!')
+        rows = pyarrow.parquet.read_table(shard_fname).to_pylist()
+        return list(filter(lambda it: it['sample_idx'] < self.processed_samples, rows))
+
+    def flush_shard(self, rows: List[Dict[str, Any]]):
+        import pyarrow
+        import pyarrow.parquet
+
+        shard_fname = self.get_shard_name(self.n_shards)
+        table = pyarrow.Table.from_pylist(rows, schema=get_parquet_schema())
+        pyarrow.parquet.write_table(table, shard_fname + '.tmp')
+        os.replace(shard_fname + '.tmp', shard_fname)
+        self.spill_fp.close()
+        os.remove(self.get_spill_name(self.n_shards))
+        self.spill_fp = None
+        self.n_shards += 1
+
+    def spill(self, rows: List[Dict[str, Any]]):
+        if self.spill_fp is None:
+            self.spill_fp = open(self.get_spill_name(self.n_shards), mode='w', encoding='utf-8')
+        for cur_row in rows:
+            self.spill_fp.write(json.dumps(cur_row, ensure_ascii=False) + '\n')
+        self.spill_fp.flush()
+        os.fsync(self.spill_fp.fileno())
+        self.spill_size = os.fstat(self.spill_fp.fileno()).st_size
+
+    def write(self, rows: List[Dict[str, Any]]) -> bool:
+        if len(rows) == 0:
+            return False
+        n_buffered = len(self.buffer)
+        self.buffer += rows
+        while len(self.buffer) >= self.rows_per_shard:
+            self.flush_shard(self.buffer[0:self.rows_per_shard])
+            self.buffer = self.buffer[self.rows_per_shard:]
+            n_buffered = 0
+        # the spill file of a new shard gets all its buffered rows
+        self.spill(self.buffer[n_buffered:])
+        self.n_rows += len(rows)
+        self.processed_samples = rows[-1]['sample_idx'] + 1
+        return True
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.flush_shard(self.buffer)
+            self.buffer = []
         else:
-            data_samples.append((full_text, prepared_coreference_chains))
-        del filled_chars
-    return data_samples
+            self.spill_fp.close()
+            os.remove(self.get_spill_name(self.n_shards))
+            self.spill_fp = None
+        self.spill_size = 0
+
+
+class IncrementalDatasetWriter(DatasetWriter):
+    """ Writer of rows of every input file into its own JSONL file, so the dataset can be updated by changed files.
+
+    Samples are numbered by the list of new input files with their manifest entries, and all rows of a sample are
+    written at once. The entry of a new file gets into the manifest of files when its rows are stored, and the rows
+    files of input files which are absent from the manifest are removed, because they are deleted or changed.
+    """
+
+    ROW_FIELDS = ['source_text', 'text_with_substitutions', 'n_substitutions', 'text_without_coreference']
+
+    def __init__(self, output_dir: str, files: Dict[str, Dict[str, Any]], new_files: List[Tuple[str, Dict[str, Any]]]):
+        super().__init__(output_dir)
+        self.files = dict(files)
+        self.new_files = new_files
+        self.n_rows = sum(map(lambda it: it['n_rows'], self.files.values()))
+        for cur_fname in os.listdir(output_dir):
+            if cur_fname.endswith('.jsonl') and (cur_fname[:-len('.jsonl')] not in self.files):
+                os.remove(os.path.join(output_dir, cur_fname))
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        res = super().state
+        res['files'] = self.files
+        return res
+
+    def get_rows_name(self, base_name: str) -> str:
+        return os.path.join(self.output_dir, base_name + '.jsonl')
+
+    def store_files(self, n_processed_files: int, rows: Dict[int, List[Dict[str, Any]]]):
+        for file_idx in range(self.processed_samples, n_processed_files):
+            cur_fname, new_entry = self.new_files[file_idx]
+            base_name = os.path.basename(cur_fname)
+            file_rows = rows.get(file_idx, [])
+            if len(file_rows) > 0:
+                rows_fname = self.get_rows_name(base_name)
+                with codecs.open(rows_fname + '.tmp', mode='w', encoding='utf-8') as fp:
+                    for cur_row in file_rows:
+                        fp.write(json.dumps(cur_row, ensure_ascii=False) + '\n')
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(rows_fname + '.tmp', rows_fname)
+            self.files[base_name] = dict(new_entry, n_rows=len(file_rows))
+            self.n_rows += len(file_rows)
+        self.processed_samples = max(self.processed_samples, n_processed_files)
+
+    def write(self, rows: List[Dict[str, Any]]) -> bool:
+        if len(rows) == 0:
+            return False
+        rows_of_files = dict()
+        for cur_row in rows:
+            rows_of_files.setdefault(cur_row['sample_idx'], []).append({it: cur_row[it] for it in self.ROW_FIELDS})
+        # files before the last written one are processed, even if they have no rows because of skipped samples
+        self.store_files(rows[-1]['sample_idx'] + 1, rows_of_files)
+        return True
+
+    def close(self):
+        self.store_files(len(self.new_files), dict())
+
+
+def iterate_incremental_rows(rows_dir: str, files: Dict[str, Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """ Iterate over rows written by IncrementalDatasetWriter in the order of input files, and number them. """
+    sample_idx = 0
+    for base_name in sorted(files.keys()):
+        if files[base_name]['n_rows'] == 0:
+            continue
+        with codecs.open(os.path.join(rows_dir, base_name + '.jsonl'), mode='r', encoding='utf-8') as fp:
+            for cur_line in fp:
+                prep_line = cur_line.strip()
+                if len(prep_line) == 0:
+                    continue
+                row = json.loads(prep_line)
+                row['sample_idx'] = sample_idx
+                sample_idx += 1
+                yield row
+
+
+def write_rows(rows: Iterable[Dict[str, Any]], writer: DatasetWriter, batch_size: int = 1000) -> int:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            writer.write(batch)
+            batch = []
+    if len(batch) > 0:
+        writer.write(batch)
+    writer.close()
+    return writer.n_rows
+
+
+def iterate_dataset(dataset_dir: str, output_format: str) -> Iterator[Dict[str, Any]]:
+    if output_format == 'parquet':
+        import pyarrow.parquet
+
+        shard_names = sorted(filter(lambda it: (SHARD_NAME_RE.match(it) is not None) and it.endswith('.parquet'),
+                                    os.listdir(dataset_dir)))
+        for cur_fname in shard_names:
+            yield from pyarrow.parquet.read_table(os.path.join(dataset_dir, cur_fname)).to_pylist()
+    elif output_format == 'csv':
+        with open(os.path.join(dataset_dir, 'train_data.csv'), mode='r', encoding='utf-8', newline='') as fp:
+            for row in csv.DictReader(fp, delimiter=',', quotechar='"'):
+                if 'sample_idx' in row:
+                    row['sample_idx'] = int(row['sample_idx'])
+                yield row
+    else:
+        raise ValueError(f'The output format "{output_format}" is unknown!')
+
+
+def merge_datasets(dataset_dirs: List[str], output_format: str, writer: DatasetWriter,
+                   batch_size: int = 1000) -> int:
+    """ Merge datasets with disjoint sets of samples into one dataset ordered by sample indices. """
+    def check_rows(dataset_dir: str) -> Iterator[Dict[str, Any]]:
+        prev_sample_idx = -1
+        for row in iterate_dataset(dataset_dir, output_format):
+            if 'sample_idx' not in row:
+                raise IOError(f'The dataset "{dataset_dir}" cannot be merged, because it has no sample indices!')
+            if row['sample_idx'] <= prev_sample_idx:
+                raise IOError(f'The dataset "{dataset_dir}" is not ordered by sample indices!')
+            prev_sample_idx = row['sample_idx']
+            yield row
+
+    return write_rows(heapq.merge(*[check_rows(it) for it in dataset_dirs], key=lambda it: it['sample_idx']), writer,
+                      batch_size)
@@ -1,6 +1,10 @@
-from typing import Dict, List, Tuple
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import spacy
+from spacy.tokens import Doc
 from pymorphy3.analyzer import Parse
 from pymorphy3.tagset import OpencorporaTag
 from pymorphy3 import MorphAnalyzer
@@ -40,8 +44,96 @@ NUMBER_DICT: Dict[str, str] = {
 }
 
 
-def initialize_nlp() -> Tuple[spacy.Language, MorphAnalyzer]:
-    return spacy.load('ru_core_news_lg'), MorphAnalyzer()
+MORPH_CACHE_SIZE: int = 65536
+
+SPACY_MODEL: str = 'ru_core_news_lg'
+
+# the tagger and the dependency parser with their shared embeddings, without the lemmatizer and NER,
+# which are never used for inflection
+NLP_COMPONENTS: Tuple[str, ...] = ('tok2vec', 'morphologizer', 'parser', 'attribute_ruler')
+
+
+class CachedMorphAnalyzer:
+    """ MorphAnalyzer with bounded LRU caches for word parsing and for selection of the best parsing variant. """
+
+    def __init__(self, morph: MorphAnalyzer, maxsize: int = MORPH_CACHE_SIZE):
+        self.morph = morph
+        self.maxsize = maxsize
+        self._parse = lru_cache(maxsize=maxsize)(morph.parse)
+        self._find_best_parsing = lru_cache(maxsize=maxsize)(self._select_best_parsing)
+
+    def _select_best_parsing(self, word: str, pos: str, case: str, number: str) -> Parse:
+        return find_best_parsing(self._parse(word), pos, case, number)
+
+    def parse(self, word: str) -> List[Parse]:
+        return self._parse(word)
+
+    def find_best_parsing(self, word: str, pos: str, case: str, number: str) -> Parse:
+        return self._find_best_parsing(word, pos, case, number)
+
+    @property
+    def hits(self) -> int:
+        return self._find_best_parsing.cache_info().hits
+
+    @property
+    def misses(self) -> int:
+        return self._find_best_parsing.cache_info().misses
+
+    def cache_info(self) -> Dict[str, int]:
+        parse_info = self._parse.cache_info()
+        best_info = self._find_best_parsing.cache_info()
+        return {
+            'parse_hits': parse_info.hits,
+            'parse_misses': parse_info.misses,
+            'parse_size': parse_info.currsize,
+            'best_parsing_hits': best_info.hits,
+            'best_parsing_misses': best_info.misses,
+            'best_parsing_size': best_info.currsize,
+            'maxsize': self.maxsize
+        }
+
+    def cache_clear(self):
+        self._parse.cache_clear()
+        self._find_best_parsing.cache_clear()
+
+
+def list_nlp_components(model_name: str = SPACY_MODEL) -> List[str]:
+    if spacy.util.is_package(model_name):
+        model_path = spacy.util.get_package_path(model_name)
+    else:
+        model_path = Path(model_name)
+    meta = spacy.util.get_model_meta(model_path)
+    return list(meta.get('components', meta.get('pipeline', [])))
+
+
+@lru_cache(maxsize=None)
+def _load_nlp(model_name: str, components: Optional[Tuple[str, ...]],
+              morph_cache_size: int) -> Tuple[spacy.Language, Union[MorphAnalyzer, CachedMorphAnalyzer]]:
+    if components is None:
+        nlp = spacy.load(model_name)
+    else:
+        all_components = list_nlp_components(model_name)
+        unknown_components = sorted(set(components) - set(all_components))
+        if len(unknown_components) > 0:
+            raise ValueError(f'The components {unknown_components} are not found in the spaCy model "{model_name}"! '
+                             f'Expected some of {all_components}.')
+        nlp = spacy.load(model_name, exclude=[it for it in all_components if it not in components])
+    morph = MorphAnalyzer()
+    if morph_cache_size > 0:
+        morph = CachedMorphAnalyzer(morph, morph_cache_size)
+    return nlp, morph
+
+
+def initialize_nlp(morph_cache_size: int = MORPH_CACHE_SIZE, components: Optional[Sequence[str]] = NLP_COMPONENTS,
+                   model_name: str = SPACY_MODEL) -> Tuple[spacy.Language, Union[MorphAnalyzer, CachedMorphAnalyzer]]:
+    """ Load the spaCy pipeline and the morphological analyzer, or return the ones loaded for the same arguments.
+
+    The pipeline keeps only the listed components (all of them if components is None). The returned objects are
+    shared by all callers in the process, so they must not be modified.
+    """
+    if components is not None:
+        components = tuple(sorted(set(components)))
+    return _load_nlp(model_name, components, morph_cache_size)
 
 
 def check_grammeme(grammeme: str, tag: OpencorporaTag) -> int:
@@ -67,9 +159,9 @@ def find_best_parsing(variants_of_parsing: List[Parse], pos: str, case: str, num
     return best_variant
 
 
-def parse_text(text: str, nlp: spacy.Language, morph: MorphAnalyzer) -> List[Tuple[int, int, Parse]]:
-    doc = nlp(text)
-    parsed = []
+def iterate_parsed_tokens(doc: Doc,
+                          morph: Union[MorphAnalyzer, CachedMorphAnalyzer]) -> Iterator[Tuple[int, int, Parse]]:
+    variants_of_parsing = dict()
     for token in doc:
         pos = POS_DICT.get(str(token.pos_), str(token.pos_))
         case = token.morph.get('Case')
@@ -88,17 +180,106 @@ def parse_text(text: str, nlp: spacy.Language, morph: MorphAnalyzer) -> List[Tup
                 number = ''
         else:
             number = ''
-        parsed.append(
-            (
-                token.idx,
-                token.idx + len(token.text),
-                find_best_parsing(morph.parse(token.text), pos, case, number)
-            )
-        )
+        if isinstance(morph, CachedMorphAnalyzer):
+            best_variant = morph.find_best_parsing(token.text, pos, case, number)
+        else:
+            if token.text not in variants_of_parsing:
+                variants_of_parsing[token.text] = morph.parse(token.text)
+            best_variant = find_best_parsing(variants_of_parsing[token.text], pos, case, number)
+        yield token.idx, token.idx + len(token.text), best_variant
+    del variants_of_parsing
+
+
+class TokenTable:
+    """ Compact table of parsed tokens with character offsets in NumPy arrays and interned parsing variants.
+
+    Tokens are ordered by their offsets, so the token containing a character is found with a binary search.
+    Indexing and iteration give the same (start, end, parse) tuples as the list returned by parse_text.
+    """
+
+    def __init__(self, tokens: Iterable[Tuple[int, int, Parse]]):
+        starts = []
+        ends = []
+        parse_ids = []
+        self.parses: List[Parse] = []
+        interned = dict()
+        for start_pos, end_pos, parse in tokens:
+            starts.append(start_pos)
+            ends.append(end_pos)
+            parse_key = id(parse)
+            if parse_key not in interned:
+                interned[parse_key] = len(self.parses)
+                self.parses.append(parse)
+            parse_ids.append(interned[parse_key])
+        self.starts = np.array(starts, dtype=np.int32)
+        self.ends = np.array(ends, dtype=np.int32)
+        self.parse_ids = np.array(parse_ids, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return self.starts.shape[0]
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Tuple[int, int, Parse], List[Tuple[int, int, Parse]]]:
+        if isinstance(idx, slice):
+            return [self[it] for it in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if (idx < 0) or (idx >= len(self)):
+            raise IndexError(f'The token index {idx} is out of range.')
+        return int(self.starts[idx]), int(self.ends[idx]), self.parses[self.parse_ids[idx]]
+
+    def __iter__(self) -> Iterator[Tuple[int, int, Parse]]:
+        for start_pos, end_pos, parse_id in zip(self.starts.tolist(), self.ends.tolist(), self.parse_ids.tolist()):
+            yield start_pos, end_pos, self.parses[parse_id]
+
+    def to_list(self) -> List[Tuple[int, int, Parse]]:
+        return list(self)
+
+    def find(self, char_idx: int) -> int:
+        found_idx = int(np.searchsorted(self.starts, char_idx, side='right')) - 1
+        if (found_idx < 0) or (char_idx >= self.ends[found_idx]):
+            return -1
+        return found_idx
+
+
+def parse_doc(doc: Doc, morph: Union[MorphAnalyzer, CachedMorphAnalyzer]) -> List[Tuple[int, int, Parse]]:
+    return list(iterate_parsed_tokens(doc, morph))
+
+
+def parse_doc_as_table(doc: Doc, morph: Union[MorphAnalyzer, CachedMorphAnalyzer]) -> TokenTable:
+    return TokenTable(iterate_parsed_tokens(doc, morph))
+
+
+def parse_text(text: str, nlp: spacy.Language,
+               morph: Union[MorphAnalyzer, CachedMorphAnalyzer]) -> List[Tuple[int, int, Parse]]:
+    doc = nlp(text)
+    parsed = parse_doc(doc, morph)
     del doc
     return parsed
 
 
+def parse_text_with_doc(text: str, nlp: spacy.Language,
+                        morph: Union[MorphAnalyzer, CachedMorphAnalyzer]) -> Tuple[Doc, List[Tuple[int, int, Parse]]]:
+    doc = nlp(text)
+    return doc, parse_doc(doc, morph)
+
+
+def parse_text_as_table(text: str, nlp: spacy.Language,
+                        morph: Union[MorphAnalyzer, CachedMorphAnalyzer]) -> Tuple[Doc, TokenTable]:
+    doc = nlp(text)
+    return doc, parse_doc_as_table(doc, morph)
+
+
+def parse_texts(texts: Iterable[str], nlp: spacy.Language, morph: Union[MorphAnalyzer, CachedMorphAnalyzer],
+                batch_size: int = 32, n_process: int = 1) -> List[List[Tuple[int, int, Parse]]]:
+    return [parse_doc(doc, morph) for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process)]
+
+
+def parse_texts_as_tables(texts: Iterable[str], nlp: spacy.Language,
+                          morph: Union[MorphAnalyzer, CachedMorphAnalyzer], batch_size: int = 32,
+                          n_process: int = 1) -> List[TokenTable]:
+    return [parse_doc_as_table(doc, morph) for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process)]
+
+
 def find_main_token(phrase: str, nlp: spacy.Language) -> Tuple[int, bool]:
     doc = nlp(phrase)
     if len(doc) < 2:
@@ -114,16 +295,32 @@ def find_main_token(phrase: str, nlp: spacy.Language) -> Tuple[int, bool]:
     return found_idx, is_noun
 
 
-def get_case_and_number(full_text: str, tokens: List[Tuple[int, int, Parse]], subphrase_start: int, subphrase_end: int,
-                        nlp: spacy.Language) -> Tuple[str, str]:
-    source_subphrase = full_text[tokens[subphrase_start][0]:tokens[subphrase_start][1]]
+def find_main_token_in_doc(doc: Doc, subphrase_start: int, subphrase_end: int) -> Tuple[int, bool]:
+    span = doc[subphrase_start:subphrase_end]
+    if len(span) < 2:
+        return 0, (span[0].pos_ in {'NOUN', 'NPRO'})
+    # the syntactic head of the span is found in the dependency tree of the whole document
+    main_token = span.root
+    return main_token.i - subphrase_start, (main_token.pos_ == 'NOUN')
+
+
+def join_subphrase(full_text: str, tokens: Union[List[Tuple[int, int, Parse]], TokenTable], subphrase_start: int,
+                   subphrase_end: int) -> str:
+    parts = [full_text[tokens[subphrase_start][0]:tokens[subphrase_start][1]]]
     for token_index in range(subphrase_start + 1, subphrase_end):
-        n_spaces = tokens[token_index][0] - tokens[token_index - 1][1]
-        while n_spaces > 0:
-            source_subphrase += ' '
-            n_spaces -= 1
-        source_subphrase += full_text[tokens[token_index][0]:tokens[token_index][1]]
-    main_token_index, is_noun = find_main_token(source_subphrase, nlp)
+        parts.append(' ' * (tokens[token_index][0] - tokens[token_index - 1][1]))
+        parts.append(full_text[tokens[token_index][0]:tokens[token_index][1]])
+    return ''.join(parts)
+
+
+def get_case_and_number(full_text: str, tokens: Union[List[Tuple[int, int, Parse]], TokenTable], subphrase_start: int,
+                        subphrase_end: int, nlp: Optional[spacy.Language],
+                        doc: Optional[Doc] = None) -> Tuple[str, str]:
+    if doc is None:
+        source_subphrase = join_subphrase(full_text, tokens, subphrase_start, subphrase_end)
+        main_token_index, is_noun = find_main_token(source_subphrase, nlp)
+    else:
+        main_token_index, is_noun = find_main_token_in_doc(doc, subphrase_start, subphrase_end)
     source_case = tokens[main_token_index + subphrase_start][2].tag.case
     source_number = tokens[main_token_index + subphrase_start][2].tag.number
     if source_number is None:
@@ -156,7 +353,9 @@ def inflect_word(word: Parse, target_case: str, target_number: str) -> str:
     return inflected.word
 
 
-def find_token_by_character_index(tokens: List[Tuple[int, int, Parse]], char_idx: int) -> int:
+def find_token_by_character_index(tokens: Union[List[Tuple[int, int, Parse]], TokenTable], char_idx: int) -> int:
+    if isinstance(tokens, TokenTable):
+        return tokens.find(char_idx)
     found_idx = -1
     for idx, (start_pos, end_pos, _) in enumerate(tokens):
         if (char_idx >= start_pos) and (char_idx < end_pos):
@@ -165,36 +364,148 @@ def find_token_by_character_index(tokens: List[Tuple[int, int, Parse]], char_idx
     return found_idx
 
 
-def inflect_subphrase(full_text: str, tokens: List[Tuple[int, int, Parse]], subphrase_start: int, subphrase_end: int,
-                      nlp: spacy.Language, target_case: str, target_number: str) -> Tuple[str, bool]:
-    source_subphrase = full_text[tokens[subphrase_start][0]:tokens[subphrase_start][1]]
-    for token_index in range(subphrase_start + 1, subphrase_end):
-        n_spaces = tokens[token_index][0] - tokens[token_index - 1][1]
-        while n_spaces > 0:
-            source_subphrase += ' '
-            n_spaces -= 1
-        source_subphrase += full_text[tokens[token_index][0]:tokens[token_index][1]]
-    main_token_index, is_noun = find_main_token(source_subphrase, nlp)
-    if not is_noun:
-        return source_subphrase, False
-    inflected_subphrase = inflect_word(tokens[subphrase_start][2], target_case, target_number)
-    if full_text[tokens[subphrase_start][0]:tokens[subphrase_start][1]].isupper():
-        inflected_subphrase = inflected_subphrase.upper()
-    elif full_text[tokens[subphrase_start][0]:tokens[subphrase_start][1]].istitle():
-        inflected_subphrase = inflected_subphrase.title()
-    for token_index in range(subphrase_start + 1, subphrase_end):
-        n_spaces = tokens[token_index][0] - tokens[token_index - 1][1]
-        while n_spaces > 0:
-            inflected_subphrase += ' '
-            n_spaces -= 1
-        if (token_index - subphrase_start) <= main_token_index:
-            new_word = inflect_word(tokens[token_index][2], target_case, target_number)
-            old_word = full_text[tokens[token_index][0]:tokens[token_index][1]]
-            if old_word.isupper():
-                new_word = new_word.upper()
-            elif old_word.istitle():
-                new_word = new_word.title()
-        else:
-            new_word = full_text[tokens[token_index][0]:tokens[token_index][1]]
-        inflected_subphrase += new_word
-    return inflected_subphrase, True
+def restore_letter_case(new_word: str, old_word: str) -> str:
+    if old_word.isupper():
+        return new_word.upper()
+    if old_word.istitle():
+        return new_word.title()
+    return new_word
+
+
+def inflect_subphrases(full_text: str, tokens: Union[List[Tuple[int, int, Parse]], TokenTable],
+                       requests: List[Tuple[int, int, str, str]], nlp: Optional[spacy.Language],
+                       doc: Optional[Doc] = None, skip_errors: bool = False) -> List[Tuple[str, bool]]:
+    """ Inflect many subphrases of one parsed document in a single pass.
+
+    Every request is (subphrase_start, subphrase_end, target_case, target_number) in token indices, and every result
+    is the same (inflected subphrase, is inflected) pair as the one returned by inflect_subphrase. Syntactic heads
+    and inflected words are found once per document and reused by all requests. If skip_errors is True, then
+    a subphrase which cannot be inflected is returned as is instead of raising RuntimeError.
+    """
+    main_tokens = dict()
+    heads_of_phrases = dict()
+    inflected_words = dict()
+
+    def inflect_token(token_index: int, target_case: str, target_number: str) -> str:
+        start_pos, end_pos, parse = tokens[token_index]
+        word_key = (id(parse), target_case, target_number)
+        if word_key not in inflected_words:
+            inflected_words[word_key] = inflect_word(parse, target_case, target_number)
+        return restore_letter_case(inflected_words[word_key], full_text[start_pos:end_pos])
+
+    results = []
+    for subphrase_start, subphrase_end, target_case, target_number in requests:
+        subphrase_key = (subphrase_start, subphrase_end)
+        if subphrase_key not in main_tokens:
+            if doc is None:
+                source_subphrase = join_subphrase(full_text, tokens, subphrase_start, subphrase_end)
+                if source_subphrase not in heads_of_phrases:
+                    heads_of_phrases[source_subphrase] = find_main_token(source_subphrase, nlp)
+                main_tokens[subphrase_key] = heads_of_phrases[source_subphrase]
+            else:
+                main_tokens[subphrase_key] = find_main_token_in_doc(doc, subphrase_start, subphrase_end)
+        main_token_index, is_noun = main_tokens[subphrase_key]
+        if not is_noun:
+            results.append((join_subphrase(full_text, tokens, subphrase_start, subphrase_end), False))
+            continue
+        parts = []
+        try:
+            for token_index in range(subphrase_start, subphrase_end):
+                start_pos, end_pos, _ = tokens[token_index]
+                if token_index > subphrase_start:
+                    parts.append(' ' * (start_pos - tokens[token_index - 1][1]))
+                if (token_index == subphrase_start) or ((token_index - subphrase_start) <= main_token_index):
+                    parts.append(inflect_token(token_index, target_case, target_number))
+                else:
+                    parts.append(full_text[start_pos:end_pos])
+        except RuntimeError:
+            if not skip_errors:
+                raise
+            results.append((join_subphrase(full_text, tokens, subphrase_start, subphrase_end), False))
+            continue
+        results.append((''.join(parts), True))
+    return results
+
+
+def inflect_subphrase(full_text: str, tokens: Union[List[Tuple[int, int, Parse]], TokenTable], subphrase_start: int,
+                      subphrase_end: int, nlp: Optional[spacy.Language], target_case: str, target_number: str,
+                      doc: Optional[Doc] = None) -> Tuple[str, bool]:
+    return inflect_subphrases(full_text, tokens, [(subphrase_start, subphrase_end, target_case, target_number)],
+                              nlp, doc)[0]
+
+
+def inflect_substitutions(source_text: str, substitutions: List[Tuple[int, int, int, int, str]],
+                          nlp: Optional[spacy.Language], morph: Union[MorphAnalyzer, CachedMorphAnalyzer],
+                          doc: Optional[Doc] = None) -> Optional[str]:
+    """ Replace coreferent mentions by their main entities, inflected to the case and number of the mentions.
+
+    Substitutions are (source_start, source_end, target_start, target_end, main_entity) from the substitution plan,
+    and every main entity is one of the mentions of its chain. None is returned if some substitution is ambiguous
+    for rules: a mention is not aligned with tokens or contains a possessive word, its case is unknown, its gender
+    differs from the main entity one, or the main entity cannot be inflected or capitalized correctly.
+    """
+    if doc is None:
+        doc = nlp(source_text)
+    tokens = parse_doc_as_table(doc, morph)
+    spans = []
+    for source_start, source_end, _, _, _ in substitutions:
+        token_start = tokens.find(source_start)
+        token_end = tokens.find(source_end - 1) + 1
+        if (token_start < 0) or (token_end <= token_start):
+            return None
+        if (tokens[token_start][0] != source_start) or (tokens[token_end - 1][1] != source_end):
+            return None
+        spans.append((token_start, token_end))
+    main_spans = dict()
+    for (source_start, source_end, _, _, main_entity), span in zip(substitutions, spans):
+        if source_text[source_start:source_end] == main_entity:
+            main_spans.setdefault(main_entity, span)
+
+    def get_gender(token_start: int, token_end: int) -> Optional[str]:
+        main_token_index, _ = find_main_token_in_doc(doc, token_start, token_end)
+        return tokens[token_start + main_token_index][2].tag.gender
+
+    requests = []
+    for (_, _, _, _, main_entity), (token_start, token_end) in zip(substitutions, spans):
+        if main_entity not in main_spans:
+            return None
+        if any(map(lambda it: 'Yes' in doc[it].morph.get('Poss'), range(token_start, token_end))):
+            return None
+        target_case, target_number = get_case_and_number(source_text, tokens, token_start, token_end, nlp, doc)
+        if len(target_case) == 0:
+            return None
+        requests.append(main_spans[main_entity] + (target_case, target_number))
+    inflected = inflect_subphrases(source_text, tokens, requests, nlp, doc, skip_errors=True)
+
+    parts = []
+    prev_end = 0
+    for (source_start, source_end, _, _, main_entity), (token_start, token_end), request, (new_entity, ok) in zip(
+            substitutions, spans, requests, inflected):
+        parts.append(source_text[prev_end:source_start])
+        prev_end = source_end
+        main_start, main_end = main_spans[main_entity]
+        if (token_start, token_end) == (main_start, main_end):
+            parts.append(main_entity)
+            continue
+        main_case, main_number = get_case_and_number(source_text, tokens, main_start, main_end, nlp, doc)
+        if (not ok) and ((main_case, main_number) != (request[2], request[3])):
+            return None
+        if not ok:
+            new_entity = main_entity
+        mention_gender = get_gender(token_start, token_end)
+        main_gender = get_gender(main_start, main_end)
+        if (mention_gender is not None) and (main_gender is not None) and (mention_gender != main_gender):
+            return None
+        if doc[token_start].is_sent_start:
+            new_entity = new_entity[0].upper() + new_entity[1:]
+        elif doc[main_start].is_sent_start and new_entity[0].isupper():
+            # the capital letter of the main entity may be due to the start of its sentence only
+            first_word = source_text[tokens[main_start][0]:tokens[main_start][1]]
+            if doc[main_start].pos_ == 'NOUN':
+                if not first_word.isupper():
+                    new_entity = new_entity[0].lower() + new_entity[1:]
+            elif (doc[main_start].pos_ != 'PROPN') and (not first_word.isupper()):
+                return None
+        parts.append(new_entity)
+    parts.append(source_text[prev_end:])
+    return ''.join(parts)
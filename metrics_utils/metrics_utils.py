@@ -0,0 +1,156 @@
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+from threading import Lock
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+STAGES: List[str] = ['setup', 'load', 'substitute', 'inflect', 'render', 'prefill', 'decode', 'generate', 'write']
+METRIC_PREFIX: str = 'prepare_dataset'
+
+
+def get_peak_host_memory() -> int:
+    # ru_maxrss is measured in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_peak_accelerator_memory() -> int:
+    # torch is imported lazily, so its memory statistics are available only if the model is loaded already
+    torch = sys.modules.get('torch')
+    if (torch is None) or (not torch.cuda.is_available()) or (not torch.cuda.is_initialized()):
+        return 0
+    return sum(torch.cuda.max_memory_allocated(device_idx) for device_idx in range(torch.cuda.device_count()))
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class RunMetrics:
+    """ Thread-safe accumulator of stage times, counters and skipped samples of a dataset preparation run.
+
+    The summary is exported into a JSON file and, optionally, into a Prometheus textfile, which can be collected
+    by the textfile collector of node_exporter while the run is in progress.
+    """
+
+    def __init__(self, json_fname: str = '', prometheus_fname: str = '', labels: Optional[Dict[str, str]] = None):
+        self.json_fname = json_fname
+        self.prometheus_fname = prometheus_fname
+        # constant labels distinguish metrics of parallel runs, for example of dataset shards
+        self.labels = dict() if labels is None else labels
+        self.start_time = time.perf_counter()
+        self.stage_times: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        self.counters: Dict[str, int] = dict()
+        self.skipped: Dict[str, int] = dict()
+        self._lock = Lock()
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start_time)
+
+    def timed(self, iterable: Iterable[Any], stage: str) -> Iterator[Any]:
+        """ Iterate over items and add the time of getting every next item to the stage. """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start_time)
+            yield item
+
+    def increment(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def skip(self, reason: str, value: int = 1):
+        with self._lock:
+            self.skipped[reason] = self.skipped.get(reason, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            wall_time = max(time.perf_counter() - self.start_time, 1e-9)
+            stage_times = dict(self.stage_times)
+            counters = dict(self.counters)
+            skipped = dict(self.skipped)
+        input_tokens = counters.get('input_tokens', 0)
+        output_tokens = counters.get('output_tokens', 0)
+        generation_time = stage_times.get('generate', 0.0)
+        draft_tokens = counters.get('draft_tokens', 0)
+        accepted_draft_tokens = counters.get('accepted_draft_tokens', 0)
+        return {
+            'wall_seconds': wall_time,
+            'stage_seconds': stage_times,
+            'counters': counters,
+            'skipped_samples': skipped,
+            'input_tokens_per_sec': input_tokens / wall_time,
+            'output_tokens_per_sec': output_tokens / wall_time,
+            'generated_tokens_per_generation_sec': (output_tokens / generation_time) if generation_time > 0 else 0.0,
+            'draft_acceptance_rate': (accepted_draft_tokens / draft_tokens) if draft_tokens > 0 else 0.0,
+            'peak_host_memory_bytes': get_peak_host_memory(),
+            'peak_accelerator_memory_bytes': get_peak_accelerator_memory()
+        }
+
+    def to_prometheus(self, summary: Optional[Dict[str, Any]] = None) -> str:
+        if summary is None:
+            summary = self.summary()
+        metrics: List[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]] = [
+            ('wall_seconds', 'gauge', 'Wall time of the run.', [({}, summary['wall_seconds'])]),
+            ('stage_seconds_total', 'counter', 'Busy time of every stage.',
+             [({'stage': stage}, seconds) for stage, seconds in summary['stage_seconds'].items()]),
+            ('events_total', 'counter', 'Numbers of processed samples, rows and tokens.',
+             [({'event': name}, value) for name, value in sorted(summary['counters'].items())]),
+            ('skipped_samples_total', 'counter', 'Numbers of skipped samples by reasons.',
+             [({'reason': reason}, value) for reason, value in sorted(summary['skipped_samples'].items())]),
+            ('tokens_per_second', 'gauge', 'Input and output tokens per second of wall time.',
+             [({'direction': 'input'}, summary['input_tokens_per_sec']),
+              ({'direction': 'output'}, summary['output_tokens_per_sec'])]),
+            ('draft_acceptance_rate', 'gauge', 'Share of tokens drafted by the prompt lookup, which are accepted.',
+             [({}, summary['draft_acceptance_rate'])]),
+            ('peak_memory_bytes', 'gauge', 'Peak memory of the host and of accelerators.',
+             [({'device': 'host'}, summary['peak_host_memory_bytes']),
+              ({'device': 'accelerator'}, summary['peak_accelerator_memory_bytes'])])
+        ]
+        lines = []
+        for name, metric_type, description, samples in metrics:
+            full_name = f'{METRIC_PREFIX}_{name}'
+            lines.append(f'# HELP {full_name} {description}')
+            lines.append(f'# TYPE {full_name} {metric_type}')
+            for sample_labels, value in samples:
+                labels = dict(self.labels)
+                labels.update(sample_labels)
+                if len(labels) > 0:
+                    labels_text = '{' + ','.join(f'{key}="{escape_label(val)}"' for key, val in labels.items()) + '}'
+                else:
+                    labels_text = ''
+                lines.append(f'{full_name}{labels_text} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self) -> Dict[str, Any]:
+        summary = self.summary()
+        if len(self.json_fname) > 0:
+            save_atomically(self.json_fname, json.dumps(summary, ensure_ascii=False, indent=4))
+        if len(self.prometheus_fname) > 0:
+            save_atomically(self.prometheus_fname, self.to_prometheus(summary))
+        return summary
+
+
+def save_atomically(fname: str, content: str):
+    # the collector must never read a partially written file
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, mode='w', encoding='utf-8') as fp:
+        fp.write(content)
+    os.replace(tmp_fname, fname)
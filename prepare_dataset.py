@@ -1,16 +1,34 @@
+from __future__ import annotations
+
 from argparse import ArgumentParser
-import codecs
-import csv
+import asyncio
+import copy
 import os
-from typing import List, Tuple
+from queue import Queue, Empty, Full
+import re
+import subprocess
+import sys
+from threading import Event, Thread
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
 import warnings
 
 from tqdm import tqdm
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers import PreTrainedTokenizer, GenerationMixin
 
-from io_utils.io_utils import load_rucoco
+from cache_utils.cache_utils import CorrectionCache, calculate_key, calculate_namespace
+from io_utils.io_utils import find_rucoco_files, load_progress, save_progress
+from io_utils.io_utils import DatasetWriter, CSVDatasetWriter, ParquetDatasetWriter
+from io_utils.io_utils import iterate_substitution_plans, save_substitution_plans, merge_datasets
+from io_utils.io_utils import IncrementalDatasetWriter, iterate_incremental_rows, iterate_rucoco_files
+from io_utils.io_utils import update_file_manifest, write_rows
+from metrics_utils.metrics_utils import RunMetrics
+from substitution_utils.substitution_utils import prepare_sample_with_plan
+
+# torch and transformers are imported by functions which use them, so the dry run, the openai backend
+# and the tests start without loading them
+if TYPE_CHECKING:
+    import torch
+    from transformers import BatchEncoding, DynamicCache, PreTrainedTokenizer, GenerationMixin
 
 
 SYSTEM_PROMPT: str = ('Представь себя опытным филологом, знатоком русского языка, и исправь, пожалуйста, '
@@ -153,7 +171,43 @@ EXAMPLES: List[Tuple[str, str]] = [
 ]
 
 
-def correct_text(source_text: str, tokenizer: PreTrainedTokenizer, model: GenerationMixin, device: str) -> str:
+MODEL_DTYPES: List[str] = ['auto', 'float32', 'bfloat16', 'float16', 'int8']
+PLANS_FNAME: str = 'substitutions.jsonl'
+METRICS_FNAME: str = 'metrics.json'
+SHARDS_DIRNAME: str = 'shards'
+FILES_MANIFEST_FNAME: str = 'files.json'
+ROWS_DIRNAME: str = 'rows'
+# options of the generation config with their neutral values, other values of which make model.generate differ from
+# the plain argmax of generate_with_prompt_lookup
+GREEDY_GENERATION_OPTIONS: Dict[str, Any] = {
+    'do_sample': False,
+    'num_beams': 1,
+    'penalty_alpha': None,
+    'dola_layers': None,
+    'repetition_penalty': 1.0,
+    'encoder_repetition_penalty': 1.0,
+    'no_repeat_ngram_size': 0,
+    'encoder_no_repeat_ngram_size': 0,
+    'bad_words_ids': None,
+    'force_words_ids': None,
+    'min_length': 0,
+    'min_new_tokens': 0,
+    'forced_bos_token_id': None,
+    'forced_eos_token_id': None,
+    'suppress_tokens': None,
+    'begin_suppress_tokens': None,
+    'sequence_bias': None,
+    'exponential_decay_length_penalty': None,
+    'guidance_scale': 1.0,
+    'watermarking_config': None,
+    'stop_strings': None,
+    'token_healing': False
+}
+# boundaries at which long texts are split into windows, from paragraphs to words
+WINDOW_BOUNDARIES: List[str] = [r'(\n\s*\n)', r'(\n)', r'(?<=[.!?…])(\s+)', r'(\s+)']
+
+
+def prepare_messages(source_text: Optional[str] = None) -> List[Dict[str, str]]:
     messages = [
         {
             'role': 'system', 'content': SYSTEM_PROMPT
@@ -168,41 +222,1127 @@ def correct_text(source_text: str, tokenizer: PreTrainedTokenizer, model: Genera
                 'role': 'assistant', 'content': true_output
             }
         ]
-    messages.append({'role': 'user', 'content': source_text})
-    text = tokenizer.apply_chat_template(
-        messages,
+    if source_text is not None:
+        messages.append({'role': 'user', 'content': source_text})
+    return messages
+
+
+def encode_prompt_prefix(tokenizer: PreTrainedTokenizer, model: GenerationMixin,
+                         device: str) -> Optional[Tuple[str, torch.Tensor, DynamicCache]]:
+    """ Encode the few-shot prompt prefix, which is shared by prompts of all texts, into the KV cache.
+
+    Some chat templates render the last assistant turn of the few-shot examples differently from earlier ones
+    (for example, Qwen3 adds an empty thinking block to the final assistant message), so the rendered prefix is not
+    a prefix of rendered prompts. Then None is returned, and full prompts are encoded without the cache.
+    """
+    prefix_text = tokenizer.apply_chat_template(
+        prepare_messages(),
+        tokenize=False,
+        add_generation_prompt=False
+    )
+    probe_text = tokenizer.apply_chat_template(
+        prepare_messages('Текст.'),
         tokenize=False,
         add_generation_prompt=True
     )
-    model_inputs = tokenizer([text], return_tensors='pt').to(device)
+    if not probe_text.startswith(prefix_text):
+        warnings.warn('The chat template does not keep the few-shot prompt as a common prefix, so the prompt prefix '
+                      'is not cached.')
+        return None
+    import torch
+    from transformers import DynamicCache
 
-    generated_ids = model.generate(
-        **model_inputs,
-        max_new_tokens=max(10, 2 * len(tokenizer.tokenize(source_text)))
-    )
-    generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
+    prefix_ids = tokenizer([prefix_text], return_tensors='pt').input_ids.to(device)
+    with torch.no_grad():
+        past_key_values = model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+    return prefix_text, prefix_ids, past_key_values
+
+
+class FirstTokenTimer:
+    """ Streamer of generated tokens, which only marks the time of the first one to separate prefill and decoding.
+
+    The generation passes the prompt into the streamer at first, and then every step of generated tokens.
+    """
+
+    def __init__(self):
+        self.n_steps = 0
+        self.first_token_time = None
+
+    def put(self, value):
+        self.n_steps += 1
+        if self.n_steps == 2:
+            self.first_token_time = time.perf_counter()
+
+    def end(self):
+        pass
+
+
+def find_draft(source_ids: List[int], generated_ids: List[int], source_position: int, num_draft_tokens: int,
+               max_ngram_size: int = 3) -> Tuple[List[int], int]:
+    """ Draft the continuation of generated tokens by the source tokens after the longest match of their last n-gram.
+
+    The corrected text is almost a copy of the source one, so matches from the current position in the source text
+    are preferred over earlier ones. The draft and its start position in the source text are returned.
+    """
+    if num_draft_tokens <= 0:
+        return [], source_position
+    if len(generated_ids) == 0:
+        return source_ids[:num_draft_tokens], 0
+    for ngram_size in range(min(max_ngram_size, len(generated_ids)), 0, -1):
+        ngram = generated_ids[-ngram_size:]
+        positions = [pos for pos in range(len(source_ids) - ngram_size)
+                     if source_ids[pos:(pos + ngram_size)] == ngram]
+        if len(positions) > 0:
+            next_positions = list(filter(lambda it: it >= source_position - ngram_size, positions))
+            draft_start = (next_positions[0] if (len(next_positions) > 0) else positions[0]) + ngram_size
+            return source_ids[draft_start:(draft_start + num_draft_tokens)], draft_start
+    return [], source_position
+
+
+def find_non_greedy_options(generation_config: Any) -> List[str]:
+    """ Find options of the generation config, which make its decoding differ from plain greedy decoding. """
+    non_greedy_options = []
+    for option_name, neutral_value in GREEDY_GENERATION_OPTIONS.items():
+        option_value = getattr(generation_config, option_name, None)
+        if (option_value is not None) and (option_value != neutral_value):
+            non_greedy_options.append(option_name)
+    return non_greedy_options
+
+
+def generate_with_prompt_lookup(model: GenerationMixin, input_ids: torch.Tensor, source_ids: List[int],
+                                max_new_tokens: int, num_draft_tokens: int,
+                                past_key_values: Optional[DynamicCache] = None,
+                                streamer: Optional[FirstTokenTimer] = None) -> Tuple[torch.Tensor, Dict[str, int]]:
+    """ Greedy decoding of one prompt, which drafts tokens from the source text and verifies them at once.
+
+    Every forward pass of the model verifies the draft (see find_draft) and yields its accepted prefix with one more
+    token of the model itself, so the result is the same as of greedy decoding. The prompt tokens are appended
+    to the past key values, which may contain some of them already (for example, the few-shot prompt prefix).
+    """
+    import torch
+
+    if past_key_values is None:
+        from transformers import DynamicCache
+
+        past_key_values = DynamicCache()
+    if not callable(getattr(past_key_values, 'crop', None)):
+        raise RuntimeError(f'The prompt lookup decoding discards rejected draft tokens from the KV cache, but '
+                           f'{type(past_key_values).__name__} cannot be cropped!')
+    eos_token_ids = model.generation_config.eos_token_id
+    if eos_token_ids is None:
+        eos_token_ids = []
+    elif isinstance(eos_token_ids, int):
+        eos_token_ids = [eos_token_ids]
+    eos_token_ids = set(eos_token_ids)
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+    stats = {'decoding_steps': 0, 'draft_tokens': 0, 'accepted_draft_tokens': 0}
+    pending_ids = input_ids[0, past_key_values.get_seq_length():].tolist()
+    generated_ids = []
+    source_position = 0
+    with torch.no_grad():
+        while len(generated_ids) < max_new_tokens:
+            draft, draft_start = find_draft(source_ids, generated_ids, source_position,
+                                            min(num_draft_tokens, max_new_tokens - len(generated_ids) - 1))
+            logits = model(
+                input_ids=torch.tensor([pending_ids + draft], dtype=input_ids.dtype, device=input_ids.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+                logits_to_keep=len(draft) + 1
+            ).logits
+            predicted_ids = logits[0, -(len(draft) + 1):].argmax(dim=-1).tolist()
+            n_matches = 0
+            while (n_matches < len(draft)) and (draft[n_matches] == predicted_ids[n_matches]):
+                n_matches += 1
+            # key values of the rejected draft tokens are discarded, and a negative argument of crop is the number
+            # of removed tokens in all versions of transformers (a positive one is deprecated)
+            if n_matches < len(draft):
+                past_key_values.crop(n_matches - len(draft))
+            if len(draft) > 0:
+                source_position = draft_start + n_matches
+            new_ids = predicted_ids[:(n_matches + 1)]
+            for token_idx, token_id in enumerate(new_ids):
+                if token_id in eos_token_ids:
+                    new_ids = new_ids[:(token_idx + 1)]
+                    break
+            stats['decoding_steps'] += 1
+            stats['draft_tokens'] += len(draft)
+            stats['accepted_draft_tokens'] += len(new_ids) - 1
+            if streamer is not None:
+                streamer.put(torch.tensor([new_ids]))
+            generated_ids += new_ids
+            if new_ids[-1] in eos_token_ids:
+                break
+            pending_ids = new_ids[-1:]
+    if streamer is not None:
+        streamer.end()
+    new_ids = torch.tensor([generated_ids], dtype=input_ids.dtype, device=input_ids.device)
+    return torch.cat([input_ids, new_ids], dim=1), stats
+
+
+def tokenize_prompts(source_texts: List[str], tokenizer: PreTrainedTokenizer,
+                     prompt_prefix: Optional[Tuple[str, torch.Tensor, DynamicCache]] = None) -> BatchEncoding:
+    import torch
+
+    texts = [
+        tokenizer.apply_chat_template(
+            prepare_messages(cur_text),
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        for cur_text in source_texts
+    ]
+    if prompt_prefix is not None:
+        prefix_text = prompt_prefix[0]
+        for cur_text in texts:
+            if not cur_text.startswith(prefix_text):
+                raise RuntimeError('The chat template does not keep the few-shot prompt as a common prefix.')
+        texts = [cur_text[len(prefix_text):] for cur_text in texts]
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = 'left'
+    try:
+        model_inputs = tokenizer(texts, return_tensors='pt', padding=True,
+                                 add_special_tokens=(prompt_prefix is None))
+    finally:
+        tokenizer.padding_side = padding_side
+    if prompt_prefix is not None:
+        # the padding of each user turn lies between the shared prefix and the turn itself,
+        # and it is masked out, so the position ids of the turn continue the prefix
+        prefix_ids = prompt_prefix[1].cpu()
+        batch_size = model_inputs.input_ids.shape[0]
+        model_inputs['input_ids'] = torch.cat([prefix_ids.expand(batch_size, -1), model_inputs.input_ids], dim=1)
+        model_inputs['attention_mask'] = torch.cat(
+            [torch.ones_like(prefix_ids).expand(batch_size, -1), model_inputs.attention_mask],
+            dim=1
+        )
+    return model_inputs
+
+
+def correct_texts(source_texts: List[str], tokenizer: PreTrainedTokenizer, model: GenerationMixin, device: str,
+                  prompt_prefix: Optional[Tuple[str, torch.Tensor, DynamicCache]] = None,
+                  metrics: Optional[RunMetrics] = None, prompt_lookup_num_tokens: int = 0) -> List[str]:
+    """ Correct texts by greedy decoding of the large language model.
+
+    If prompt_lookup_num_tokens is positive, then texts are decoded one by one with drafts from the source texts
+    (see generate_with_prompt_lookup).
+    """
+    if len(source_texts) == 0:
+        return []
+    if metrics is None:
+        metrics = RunMetrics()
+    if (prompt_lookup_num_tokens > 0) and (len(source_texts) > 1):
+        return [
+            correct_texts([cur_text], tokenizer, model, device, prompt_prefix, metrics, prompt_lookup_num_tokens)[0]
+            for cur_text in source_texts
+        ]
+    with metrics.measure('render'):
+        model_inputs = tokenize_prompts(source_texts, tokenizer, prompt_prefix).to(device)
+        max_source_length = max(map(lambda it: len(tokenizer.tokenize(it)), source_texts))
+    generation_kwargs = dict()
+    if prompt_prefix is not None:
+        past_key_values = copy.deepcopy(prompt_prefix[2])
+        if len(source_texts) > 1:
+            past_key_values.batch_repeat_interleave(len(source_texts))
+        generation_kwargs['past_key_values'] = past_key_values
+
+    timer = FirstTokenTimer()
+    start_time = time.perf_counter()
+    if prompt_lookup_num_tokens > 0:
+        generated_ids, lookup_stats = generate_with_prompt_lookup(
+            model,
+            model_inputs.input_ids,
+            tokenizer(source_texts[0], add_special_tokens=False).input_ids,
+            max_new_tokens=max(10, 2 * max_source_length),
+            num_draft_tokens=prompt_lookup_num_tokens,
+            past_key_values=generation_kwargs.get('past_key_values'),
+            streamer=timer
+        )
+        for counter, value in lookup_stats.items():
+            metrics.increment(counter, value)
+    else:
+        generated_ids = model.generate(
+            **model_inputs,
+            max_new_tokens=max(10, 2 * max_source_length),
+            pad_token_id=tokenizer.pad_token_id,
+            streamer=timer,
+            **generation_kwargs
+        )
+    end_time = time.perf_counter()
+    first_token_time = end_time if timer.first_token_time is None else timer.first_token_time
+    metrics.add_time('prefill', first_token_time - start_time)
+    metrics.add_time('decode', end_time - first_token_time)
+    # all prompts are left-padded to the same length, so every answer starts right after it
+    generated_ids = generated_ids[:, model_inputs.input_ids.shape[1]:]
+    metrics.increment('input_tokens', int(model_inputs.attention_mask.sum()))
+    metrics.increment('output_tokens', int((generated_ids != tokenizer.pad_token_id).sum()))
+
+    return tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+
+
+def correct_text(source_text: str, tokenizer: PreTrainedTokenizer, model: GenerationMixin, device: str,
+                 prompt_prefix: Optional[Tuple[str, torch.Tensor, DynamicCache]] = None,
+                 metrics: Optional[RunMetrics] = None) -> str:
+    return correct_texts([source_text], tokenizer, model, device, prompt_prefix, metrics)[0]
+
+
+class CorrectionBackend:
+    """ Base class of text correction backends, which correct a list of texts with substituted mentions. """
+
+    def correct(self, source_texts: List[str]) -> List[str]:
+        raise NotImplementedError
+
+    def measure(self, source_texts: List[str]) -> List[int]:
+        """ Lengths of source texts, which are used to batch texts of similar lengths together. """
+        return [len(cur_text) for cur_text in source_texts]
+
+    def settings(self) -> Dict[str, Any]:
+        """ Everything which corrections depend on, besides the source texts. """
+        return {
+            'system_prompt': SYSTEM_PROMPT,
+            'examples': EXAMPLES
+        }
+
+    def close(self):
+        pass
+
+
+class HFCorrectionBackend(CorrectionBackend):
+    """ Correction backend with an in-process Hugging Face causal language model. """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, model: GenerationMixin, device: str,
+                 prompt_prefix: Optional[Tuple[str, torch.Tensor, DynamicCache]] = None,
+                 metrics: Optional[RunMetrics] = None, prompt_lookup_num_tokens: int = 0):
+        if prompt_lookup_num_tokens < 0:
+            raise ValueError(f'The number of prompt lookup tokens is wrong! Expected a non-negative integer, '
+                             f'got {prompt_lookup_num_tokens}.')
+        if prompt_lookup_num_tokens > 0:
+            non_greedy_options = find_non_greedy_options(model.generation_config)
+            if len(non_greedy_options) > 0:
+                raise ValueError(f'The prompt lookup decoding is plain greedy decoding, but the generation config of '
+                                 f'the model changes it by {non_greedy_options}!')
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.prompt_prefix = prompt_prefix
+        self.metrics = metrics
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+
+    def correct(self, source_texts: List[str]) -> List[str]:
+        return correct_texts(source_texts, self.tokenizer, self.model, self.device, self.prompt_prefix,
+                             self.metrics, self.prompt_lookup_num_tokens)
+
+    def measure(self, source_texts: List[str]) -> List[int]:
+        if len(source_texts) == 0:
+            return []
+        return [len(it) for it in self.tokenizer(source_texts, add_special_tokens=False).input_ids]
+
+    def settings(self) -> Dict[str, Any]:
+        settings = super().settings()
+        settings.update({
+            'backend': 'hf',
+            'model': self.model.name_or_path,
+            'dtype': str(self.model.dtype),
+            'chat_template': self.tokenizer.chat_template,
+            'generation_config': self.model.generation_config.to_json_string(use_diff=True),
+            'max_new_tokens': 'max(10, 2 * source_length)'
+        })
+        return settings
+
+
+class OpenAICorrectionBackend(CorrectionBackend):
+    """ Correction backend with an OpenAI-compatible inference server.
+
+    Texts of a batch are sent as concurrent chat completion requests through a pool of keep-alive connections.
+    At most max_concurrency requests are in flight at once, and failed requests are retried with an exponential
+    backoff.
+    """
+
+    RETRIABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str, model_name: str, api_key: str = '', max_concurrency: int = 8,
+                 max_retries: int = 5, backoff: float = 0.5, timeout: float = 600.0,
+                 max_tokens: Optional[int] = None, metrics: Optional[RunMetrics] = None):
+        if max_concurrency < 1:
+            raise ValueError(f'The maximal concurrency is wrong! Expected a positive integer, got {max_concurrency}.')
+        if max_retries < 0:
+            raise ValueError(f'The maximal number of retries is wrong! Expected a non-negative integer, '
+                             f'got {max_retries}.')
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.model_name = model_name
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.metrics = RunMetrics() if metrics is None else metrics
+        self.n_requests = 0
+        self.n_retries = 0
+        self._loop = asyncio.new_event_loop()
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            try:
+                import httpx
+            except ImportError:
+                raise RuntimeError('The httpx package is required for the OpenAI-compatible backend.')
+            headers = {'Content-Type': 'application/json'}
+            if len(self.api_key) > 0:
+                headers['Authorization'] = f'Bearer {self.api_key}'
+            self._client = httpx.AsyncClient(
+                headers=headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency)
+            )
+        return self._client
+
+    async def _correct_one(self, source_text: str, semaphore: asyncio.Semaphore) -> str:
+        import httpx
+
+        request = {
+            'model': self.model_name,
+            'messages': prepare_messages(source_text),
+            'temperature': 0.0
+        }
+        if self.max_tokens is not None:
+            request['max_tokens'] = self.max_tokens
+        client = self._get_client()
+        async with semaphore:
+            attempt = 0
+            while True:
+                self.n_requests += 1
+                try:
+                    response = await client.post(self.url, json=request)
+                    if response.status_code == 200:
+                        answer = response.json()
+                        usage = answer.get('usage') or dict()
+                        self.metrics.increment('input_tokens', usage.get('prompt_tokens', 0))
+                        self.metrics.increment('output_tokens', usage.get('completion_tokens', 0))
+                        return answer['choices'][0]['message']['content']
+                    err_msg = f'The server responded with the status {response.status_code}: {response.text}'
+                    can_retry = response.status_code in self.RETRIABLE_STATUS_CODES
+                except httpx.TransportError as err:
+                    err_msg = f'The request to {self.url} failed: {err}'
+                    can_retry = True
+                if (not can_retry) or (attempt >= self.max_retries):
+                    raise RuntimeError(err_msg)
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+                self.n_retries += 1
+
+    async def correct_async(self, source_texts: List[str]) -> List[str]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return list(await asyncio.gather(*[self._correct_one(cur_text, semaphore) for cur_text in source_texts]))
+
+    def correct(self, source_texts: List[str]) -> List[str]:
+        if len(source_texts) == 0:
+            return []
+        return self._loop.run_until_complete(self.correct_async(source_texts))
+
+    def settings(self) -> Dict[str, Any]:
+        settings = super().settings()
+        settings.update({
+            'backend': 'openai',
+            'model': self.model_name,
+            'temperature': 0.0,
+            'max_tokens': self.max_tokens
+        })
+        return settings
+
+    def close(self):
+        if self._client is not None:
+            self._loop.run_until_complete(self._client.aclose())
+            self._client = None
+        self._loop.close()
+
+
+def schedule_batches(lengths: List[int], batch_size: int) -> List[List[int]]:
+    """ Group indices of texts into batches of similar lengths, from the longest batch to the shortest one. """
+    if batch_size < 1:
+        raise ValueError(f'The batch size is wrong! Expected a positive integer, got {batch_size}.')
+    ordered = sorted(range(len(lengths)), key=lambda it: (-lengths[it], it))
+    return [ordered[batch_start:(batch_start + batch_size)] for batch_start in range(0, len(ordered), batch_size)]
+
+
+def calculate_padded_length(lengths: List[int], batches: List[List[int]]) -> int:
+    return sum(map(lambda batch: len(batch) * max(map(lambda it: lengths[it], batch)), batches))
+
+
+class BucketedCorrectionBackend(CorrectionBackend):
+    """ Correction backend which splits a window of texts into length-bucketed batches for another backend.
+
+    Texts of the window are measured, sorted by their lengths and corrected by batches of batch_size similar texts,
+    so batches waste less compute on padding. Corrections are returned in the original order of texts.
+    """
+
+    def __init__(self, backend: CorrectionBackend, batch_size: int):
+        if batch_size < 1:
+            raise ValueError(f'The batch size is wrong! Expected a positive integer, got {batch_size}.')
+        self.backend = backend
+        self.batch_size = batch_size
+        self.n_tokens = 0
+        self.n_padded_tokens = 0
+        self.n_unscheduled_padded_tokens = 0
+
+    @property
+    def padding_efficiency(self) -> float:
+        return (self.n_tokens / self.n_padded_tokens) if self.n_padded_tokens > 0 else 1.0
+
+    @property
+    def unscheduled_padding_efficiency(self) -> float:
+        return (self.n_tokens / self.n_unscheduled_padded_tokens) if self.n_unscheduled_padded_tokens > 0 else 1.0
+
+    def correct(self, source_texts: List[str]) -> List[str]:
+        lengths = self.measure(source_texts)
+        batches = schedule_batches(lengths, self.batch_size)
+        self.n_tokens += sum(lengths)
+        self.n_padded_tokens += calculate_padded_length(lengths, batches)
+        self.n_unscheduled_padded_tokens += calculate_padded_length(
+            lengths,
+            [list(range(batch_start, min(batch_start + self.batch_size, len(lengths))))
+             for batch_start in range(0, len(lengths), self.batch_size)]
+        )
+        corrected_texts = [''] * len(source_texts)
+        for cur_batch in batches:
+            batch_corrections = self.backend.correct([source_texts[it] for it in cur_batch])
+            for text_idx, corrected_text in zip(cur_batch, batch_corrections):
+                corrected_texts[text_idx] = corrected_text
+        return corrected_texts
+
+    def measure(self, source_texts: List[str]) -> List[int]:
+        return self.backend.measure(source_texts)
+
+    def settings(self) -> Dict[str, Any]:
+        return self.backend.settings()
+
+    def close(self):
+        self.backend.close()
+
+
+def split_into_windows(text: str, measure: Callable[[List[str]], List[int]], max_length: int,
+                       level: int = 0) -> Tuple[List[str], List[str]]:
+    """ Split a text into windows, whose lengths do not exceed max_length, at the coarsest possible boundaries.
+
+    Windows are returned with the separators between them, so the text is restored by their interleaving.
+    A window can be longer than max_length only if it is a single word.
+    """
+    if (level >= len(WINDOW_BOUNDARIES)) or (measure([text])[0] <= max_length):
+        return [text], []
+    splitted = re.split(WINDOW_BOUNDARIES[level], text)
+    parts = splitted[0::2]
+    separators = splitted[1::2]
+    if len(parts) < 2:
+        return split_into_windows(text, measure, max_length, level + 1)
+    windows = []
+    window_separators = []
+    window_length = 0
+    # every part is measured with its preceding separator, so lengths of windows are not underestimated
+    part_lengths = measure([parts[0]] + [separator + part for separator, part in zip(separators, parts[1:])])
+    for part_idx, (part, part_length) in enumerate(zip(parts, part_lengths)):
+        if (part_idx > 0) and (part_length + window_length <= max_length) and (window_length > 0):
+            windows[-1] += separators[part_idx - 1] + part
+            window_length += part_length
+            continue
+        if part_idx > 0:
+            window_separators.append(separators[part_idx - 1])
+        if part_length > max_length:
+            sub_windows, sub_separators = split_into_windows(part, measure, max_length, level + 1)
+            windows += sub_windows
+            window_separators += sub_separators
+            window_length = max_length
+        else:
+            windows.append(part)
+            window_length = part_length
+    return windows, window_separators
+
+
+class WindowedCorrectionBackend(CorrectionBackend):
+    """ Correction backend which corrects long texts by windows with another backend.
+
+    Every text, which is longer than max_window_length, is split into windows at paragraph or sentence boundaries.
+    The windows are corrected independently, by batches of batch_size windows (all windows at once if batch_size
+    is zero), and corrected windows are joined with the original separators.
+    """
+
+    def __init__(self, backend: CorrectionBackend, max_window_length: int, batch_size: int = 0):
+        if max_window_length < 1:
+            raise ValueError(f'The maximal window length is wrong! Expected a positive integer, '
+                             f'got {max_window_length}.')
+        if batch_size < 0:
+            raise ValueError(f'The batch size is wrong! Expected a non-negative integer, got {batch_size}.')
+        self.backend = backend
+        self.max_window_length = max_window_length
+        self.batch_size = batch_size
+        self.n_texts = 0
+        self.n_windows = 0
+
+    def correct(self, source_texts: List[str]) -> List[str]:
+        windows = []
+        separators = []
+        for cur_text in source_texts:
+            text_windows, text_separators = split_into_windows(cur_text, self.backend.measure,
+                                                               self.max_window_length)
+            windows.append(text_windows)
+            separators.append(text_separators)
+        flat_windows = [it for text_windows in windows for it in text_windows if len(it.strip()) > 0]
+        self.n_texts += len(source_texts)
+        self.n_windows += len(flat_windows)
+        batch_size = self.batch_size if self.batch_size > 0 else max(len(flat_windows), 1)
+        corrected_windows = []
+        for batch_start in range(0, len(flat_windows), batch_size):
+            corrected_windows += self.backend.correct(flat_windows[batch_start:(batch_start + batch_size)])
+        corrected_windows.reverse()
+        corrected_texts = []
+        for text_windows, text_separators in zip(windows, separators):
+            corrected_text = ''
+            for window_idx, cur_window in enumerate(text_windows):
+                if window_idx > 0:
+                    corrected_text += text_separators[window_idx - 1]
+                if len(cur_window.strip()) > 0:
+                    corrected_text += corrected_windows.pop().strip()
+                else:
+                    corrected_text += cur_window
+            corrected_texts.append(corrected_text)
+        return corrected_texts
+
+    def measure(self, source_texts: List[str]) -> List[int]:
+        return self.backend.measure(source_texts)
+
+    def settings(self) -> Dict[str, Any]:
+        settings = self.backend.settings()
+        settings['max_window_length'] = self.max_window_length
+        return settings
+
+    def close(self):
+        self.backend.close()
+
+
+class CachedCorrectionBackend(CorrectionBackend):
+    """ Correction backend which looks up corrections in a persistent cache before it calls another backend.
+
+    Only texts which are not found in the cache are corrected, and their corrections are added to the cache.
+    """
+
+    def __init__(self, backend: CorrectionBackend, cache: CorrectionCache):
+        self.backend = backend
+        self.cache = cache
+        self.namespace = calculate_namespace(backend.settings())
+
+    def correct(self, source_texts: List[str]) -> List[str]:
+        keys = [calculate_key(self.namespace, cur_text) for cur_text in source_texts]
+        found = self.cache.get_many(keys)
+        missed = dict()
+        for cur_key, cur_text in zip(keys, source_texts):
+            if cur_key not in found:
+                missed[cur_key] = cur_text
+        if len(missed) > 0:
+            corrected_texts = self.backend.correct(list(missed.values()))
+            new_items = list(zip(missed.keys(), corrected_texts))
+            self.cache.put_many(new_items)
+            found.update(new_items)
+        return [found[cur_key] for cur_key in keys]
+
+    def measure(self, source_texts: List[str]) -> List[int]:
+        return self.backend.measure(source_texts)
+
+    def settings(self) -> Dict[str, Any]:
+        return self.backend.settings()
+
+    def close(self):
+        try:
+            self.backend.close()
+        finally:
+            self.cache.close()
+
+
+def make_rows(batch: List[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]],
+              corrected_texts: List[str]) -> List[Dict[str, Any]]:
+    return [
+        {
+            'sample_idx': sample_idx,
+            'source_text': source_text,
+            'text_with_substitutions': text_with_substitutions,
+            'n_substitutions': len(substitutions),
+            'text_without_coreference': corrected_text.strip()
+        }
+        for (sample_idx, source_text, text_with_substitutions, substitutions), corrected_text in zip(batch,
+                                                                                                     corrected_texts)
     ]
 
-    return tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+
+def iterate_prepared_samples(input_path: str, n_processes: int = 1, metrics: Optional[RunMetrics] = None,
+                             num_shards: int = 1, shard_id: int = 0
+                             ) -> Iterator[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]]:
+    """ Iterate over prepared samples of the shard, which takes every num_shards-th sample starting with shard_id.
+
+    Samples of RuCoCo files are numbered by indices of the files, so every shard reads only its own files.
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    if os.path.isfile(input_path):
+        for prepared_sample in metrics.timed(iterate_substitution_plans(input_path), 'load'):
+            if prepared_sample[0] % num_shards != shard_id:
+                continue
+            metrics.increment('prepared_samples')
+            yield prepared_sample
+    else:
+        data_files = find_rucoco_files(input_path)
+        file_indices = list(range(shard_id, len(data_files), num_shards))
+        yield from iterate_file_samples([data_files[it] for it in file_indices], n_processes, metrics, file_indices)
+
+
+def iterate_file_samples(data_files: List[str], n_processes: int = 1, metrics: Optional[RunMetrics] = None,
+                         file_indices: Optional[List[int]] = None
+                         ) -> Iterator[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]]:
+    """ Iterate over prepared samples of the given RuCoCo files, which are numbered by indices of the files.
+
+    If file_indices is specified, then samples are numbered by it instead of positions of the files in the list.
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    if file_indices is None:
+        file_indices = list(range(len(data_files)))
+    samples = metrics.timed(iterate_rucoco_files(data_files, n_processes), 'load')
+    for file_idx, sample in zip(file_indices, samples):
+        if sample is None:
+            metrics.skip('overlapped_mentions')
+            continue
+        metrics.increment('loaded_samples')
+        with metrics.measure('substitute'):
+            prepared_sample = prepare_sample_with_plan(sample[0], sample[1], file_idx, metrics.skip)
+        if prepared_sample is not None:
+            metrics.increment('prepared_samples')
+            yield (file_idx,) + prepared_sample
+
+
+def assemble_dataset(output_dir: str, rows_dir: str, files: Dict[str, Dict[str, Any]], output_format: str,
+                     rows_per_shard: int) -> Tuple[int, str]:
+    """ Write the dataset from rows of all input files, which are stored by IncrementalDatasetWriter. """
+    if output_format == 'parquet':
+        writer = ParquetDatasetWriter(output_dir, None, rows_per_shard)
+        output_fname = os.path.join(output_dir, 'train-*.parquet')
+    else:
+        writer = CSVDatasetWriter(output_dir)
+        output_fname = writer.output_fname
+    return write_rows(iterate_incremental_rows(rows_dir, files), writer), output_fname
+
+
+def remove_options(argv: List[str], options: List[str]) -> List[str]:
+    """ Remove the options with values, which are given as "--option value" or "--option=value". """
+    res = []
+    skip_value = False
+    for cur_arg in argv:
+        if skip_value:
+            skip_value = False
+            continue
+        if cur_arg.split('=', 1)[0] in options:
+            skip_value = ('=' not in cur_arg)
+            continue
+        res.append(cur_arg)
+    return res
+
+
+def add_suffix(fname: str, suffix: str) -> str:
+    base_name, extension = os.path.splitext(fname)
+    return base_name + suffix + extension
+
+
+def get_shards_dir(output_dir: str) -> str:
+    """ Directory of worker outputs, which is a sibling of the output directory, so they are not loaded with it. """
+    return os.path.abspath(output_dir) + '-' + SHARDS_DIRNAME
+
+
+def make_worker_commands(argv: List[str], shards_dir: str, devices: List[str], n_threads: int,
+                         prometheus_fname: str = '') -> List[List[str]]:
+    """ Make command lines of workers, which prepare shards of the dataset in subdirectories of shards_dir. """
+    worker_argv = remove_options(argv, ['-o', '--output', '--workers', '--devices', '--device', '--num-shards',
+                                        '--shard-id', '--threads', '--metrics-json', '--prometheus-textfile'])
+    num_shards = len(devices)
+    commands = []
+    for shard_id, device in enumerate(devices):
+        command = [sys.executable, os.path.abspath(__file__)] + worker_argv + [
+            '--output', os.path.join(shards_dir, f'shard-{shard_id:05d}-of-{num_shards:05d}'),
+            '--num-shards', str(num_shards),
+            '--shard-id', str(shard_id),
+            '--device', device
+        ]
+        if n_threads > 0:
+            command += ['--threads', str(n_threads)]
+        if len(prometheus_fname) > 0:
+            command += ['--prometheus-textfile', add_suffix(prometheus_fname, f'-shard-{shard_id:05d}')]
+        commands.append(command)
+    return commands
+
+
+def run_workers(commands: List[List[str]]):
+    """ Run worker processes, and terminate all of them as soon as one fails. """
+    processes = [subprocess.Popen(command) for command in commands]
+    try:
+        while True:
+            return_codes = [process.poll() for process in processes]
+            for shard_id, return_code in enumerate(return_codes):
+                if (return_code is not None) and (return_code != 0):
+                    raise RuntimeError(f'The worker of the shard {shard_id} failed with the exit code {return_code}. '
+                                       f'Fix the problem and continue all workers with --resume.')
+            if all(map(lambda it: it is not None, return_codes)):
+                break
+            time.sleep(0.5)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def configure_threads(n_threads: int = 0, n_interop_threads: int = 0):
+    import torch
+
+    if n_interop_threads > 0:
+        torch.set_num_interop_threads(n_interop_threads)
+    if n_threads > 0:
+        torch.set_num_threads(n_threads)
+
+
+def load_model(model_name: str, device: str, dtype: str = 'auto') -> Tuple[PreTrainedTokenizer, GenerationMixin]:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    if dtype not in MODEL_DTYPES:
+        raise ValueError(f'The data type "{dtype}" is unknown! Expected one of {MODEL_DTYPES}.')
+    on_cpu = (torch.device(device).type == 'cpu')
+    if (dtype == 'int8') and (not on_cpu):
+        raise ValueError(f'The dynamic int8 quantization is not supported on the device "{device}".')
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if dtype == 'auto':
+        if on_cpu:
+            model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32).to(device)
+        else:
+            try:
+                model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16).to(device)
+            except:
+                model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float16).to(device)
+    elif dtype == 'int8':
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=getattr(torch, dtype)).to(device)
+    model.eval()
+    return tokenizer, model
+
+
+def put_until_stopped(queue: Queue, item: Any, stop_event: Event) -> bool:
+    while not stop_event.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def run_pipeline(source_data: Iterator[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]],
+                 correct: Callable[[List[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]]], List[str]],
+                 write: Callable[[List[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]], List[str]], Any],
+                 first_sample_idx: int, batch_size: int, queue_size: int) -> Dict[str, float]:
+    """ Run the preparation, the generation and the writing of samples concurrently.
+
+    The preparation worker and the writer are threads connected with the generation consumer in the calling
+    thread by bounded queues. Returned utilizations are the shares of wall time which every stage spent working
+    instead of waiting for its neighbours.
+    """
+    prepared_queue = Queue(maxsize=queue_size)
+    corrected_queue = Queue(maxsize=queue_size)
+    stop_event = Event()
+    busy_time = {'prepare': 0.0, 'generate': 0.0, 'write': 0.0}
+    errors = []
+
+    def prepare():
+        try:
+            data_iterator = iter(source_data)
+            while not stop_event.is_set():
+                start_time = time.perf_counter()
+                try:
+                    sample = next(data_iterator)
+                except StopIteration:
+                    break
+                finally:
+                    busy_time['prepare'] += time.perf_counter() - start_time
+                if sample[0] < first_sample_idx:
+                    continue
+                if not put_until_stopped(prepared_queue, sample, stop_event):
+                    break
+        except BaseException as err:
+            errors.append(err)
+            stop_event.set()
+        finally:
+            put_until_stopped(prepared_queue, None, stop_event)
+
+    def write_batches():
+        try:
+            while True:
+                item = corrected_queue.get()
+                if item is None:
+                    break
+                start_time = time.perf_counter()
+                write(*item)
+                busy_time['write'] += time.perf_counter() - start_time
+        except BaseException as err:
+            errors.append(err)
+            stop_event.set()
+
+    pipeline_start_time = time.perf_counter()
+    preparation_thread = Thread(target=prepare, daemon=True)
+    writing_thread = Thread(target=write_batches, daemon=True)
+    preparation_thread.start()
+    writing_thread.start()
+    try:
+        batch = []
+        finished = False
+        while not finished:
+            try:
+                item = prepared_queue.get(timeout=0.1)
+            except Empty:
+                if stop_event.is_set():
+                    break
+                continue
+            if item is None:
+                finished = True
+            else:
+                batch.append(item)
+            if (len(batch) >= batch_size) or (finished and (len(batch) > 0)):
+                start_time = time.perf_counter()
+                corrected_texts = correct(batch)
+                busy_time['generate'] += time.perf_counter() - start_time
+                if not put_until_stopped(corrected_queue, (batch, corrected_texts), stop_event):
+                    break
+                batch = []
+    except BaseException as err:
+        errors.append(err)
+        stop_event.set()
+    finally:
+        while writing_thread.is_alive():
+            try:
+                corrected_queue.put(None, timeout=0.1)
+                break
+            except Full:
+                pass
+        writing_thread.join()
+        stop_event.set()
+        preparation_thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    wall_time = max(time.perf_counter() - pipeline_start_time, 1e-9)
+    return {stage: stage_time / wall_time for stage, stage_time in busy_time.items()}
+
+
+def write_dataset(source_data: Iterator[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]],
+                  n_inputs: Optional[int], backend: CorrectionBackend, writer: DatasetWriter, manifest_fname: str,
+                  progress: Dict[str, Any], batch_size: int, pipelined: bool = False, queue_size: int = 8,
+                  metrics: Optional[RunMetrics] = None,
+                  inflect: Optional[Callable[[str, List[Tuple[int, int, int, int, str]]], Optional[str]]] = None
+                  ) -> int:
+    """ Correct prepared samples in batches and write them into the dataset with checkpoints of progress.
+
+    If inflect is specified, then it is tried at first for every sample with its source text and substitution plan,
+    and only samples for which it returns None are corrected by the backend.
+    """
+    first_sample_idx = progress['processed_samples']
+    if metrics is None:
+        metrics = RunMetrics()
+
+    def correct(batch: List[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]]) -> List[str]:
+        corrected_texts = [None for _ in range(len(batch))]
+        if inflect is not None:
+            with metrics.measure('inflect'):
+                corrected_texts = [inflect(it[1], it[3]) for it in batch]
+            metrics.increment('bypassed_samples', sum(map(lambda it: it is not None, corrected_texts)))
+        indices = [idx for idx, corrected_text in enumerate(corrected_texts) if corrected_text is None]
+        if len(indices) > 0:
+            with metrics.measure('generate'):
+                backend_texts = backend.correct([batch[idx][2] for idx in indices])
+            metrics.increment('corrected_samples', len(indices))
+            for idx, corrected_text in zip(indices, backend_texts):
+                corrected_texts[idx] = corrected_text
+        return corrected_texts
+
+    def write_batch(batch: List[Tuple[int, str, str, List[Tuple[int, int, int, int, str]]]],
+                    corrected_texts: List[str]):
+        with metrics.measure('write'):
+            checkpoint = writer.write(make_rows(batch, corrected_texts))
+            if checkpoint:
+                progress.update(writer.state)
+                save_progress(manifest_fname, progress)
+        metrics.increment('written_rows', len(batch))
+        if checkpoint:
+            metrics.export()
+
+    if pipelined:
+        utilization = run_pipeline(tqdm(source_data, total=n_inputs), correct, write_batch,
+                                   first_sample_idx, batch_size, queue_size)
+        print('Stage utilization: ' + ', '.join(map(lambda it: f'{it[0]} {round(100.0 * it[1], 1)}%',
+                                                      utilization.items())) + '.')
+    else:
+        batch = []
+        for sample in tqdm(source_data, total=n_inputs):
+            if sample[0] < first_sample_idx:
+                continue
+            batch.append(sample)
+            if len(batch) >= batch_size:
+                write_batch(batch, correct(batch))
+                batch = []
+        if len(batch) > 0:
+            write_batch(batch, correct(batch))
+    with metrics.measure('write'):
+        writer.close()
+        progress.update(writer.state)
+        save_progress(manifest_fname, progress)
+    metrics.export()
+    return writer.n_rows
 
 
 def main():
-    parser = ArgumentParser()
+    # abbreviated options are not allowed, because options of the parent process are removed from command lines of
+    # workers by their full names
+    parser = ArgumentParser(allow_abbrev=False)
     parser.add_argument('-i', '--input', dest='input_name', type=str, required=True,
-                        help='The path to the input RuCoCo.')
+                        help='The path to the input RuCoCo, or to the JSONL file with substitution plans '
+                             'which is created with --dry-run.')
     parser.add_argument('-o', '--output', dest='output_name', type=str, required=True,
                         help='The path to the output HF-formatted dataset.')
-    parser.add_argument('-m', '--model', dest='large_language_model', type=str, required=True,
-                        help='The large language model for text correction.')
+    parser.add_argument('-m', '--model', dest='large_language_model', type=str, required=False, default='',
+                        help='The large language model for text correction (its name on the inference server '
+                             'for the openai backend).')
+    parser.add_argument('--backend', dest='backend', type=str, required=False, default='hf', choices=['hf', 'openai'],
+                        help='The correction backend: an in-process Hugging Face model or an OpenAI-compatible '
+                             'inference server.')
+    parser.add_argument('--api-base', dest='api_base', type=str, required=False, default='http://localhost:8000/v1',
+                        help='The base URL of the OpenAI-compatible inference server.')
+    parser.add_argument('--api-key', dest='api_key', type=str, required=False,
+                        default=os.environ.get('OPENAI_API_KEY', ''),
+                        help='The API key of the OpenAI-compatible inference server.')
+    parser.add_argument('--max-concurrency', dest='max_concurrency', type=int, required=False, default=8,
+                        help='The maximal number of requests in flight to the OpenAI-compatible inference server.')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, required=False, default=5,
+                        help='The maximal number of retries of a failed request to the inference server.')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, required=False, default=1,
+                        help='The number of texts which are corrected by the large language model at once.')
+    parser.add_argument('--bucket-window', dest='bucket_window', type=int, required=False, default=0,
+                        help='The number of consecutive samples which are sorted by length and split into batches '
+                             'of similar texts (0 means batching in the input order).')
+    parser.add_argument('--max-window-length', dest='max_window_length', type=int, required=False, default=0,
+                        help='The maximal length of a text window, which is corrected at once (in tokens for the hf '
+                             'backend and in characters for the openai backend). Longer texts are split into windows '
+                             'at paragraph or sentence boundaries (0 means correction of whole texts).')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Continue an interrupted run from its last checkpoint instead of starting from scratch.')
+    parser.add_argument('--loader-processes', dest='loader_processes', type=int, required=False, default=1,
+                        help='The number of processes which read and validate RuCoCo files in parallel.')
+    parser.add_argument('--device', dest='device', type=str, required=False, default='cuda:0',
+                        help='The device for the large language model (for example, cuda:0 or cpu).')
+    parser.add_argument('--dtype', dest='dtype', type=str, required=False, default='auto', choices=MODEL_DTYPES,
+                        help='The data type of the large language model weights. The int8 type means dynamic '
+                             'quantization of linear layers, and it is available on CPU only.')
+    parser.add_argument('--no-prefix-cache', dest='no_prefix_cache', action='store_true',
+                        help='Encode the full prompt of every text instead of caching the shared few-shot prompt '
+                             'prefix.')
+    parser.add_argument('--prompt-lookup-tokens', dest='prompt_lookup_num_tokens', type=int, required=False,
+                        default=0, help='The maximal number of tokens, which are drafted from n-grams of the prompt '
+                                        'and verified at once (0 means usual greedy decoding). The prompt lookup '
+                                        'decodes texts of a batch one by one, and it requires a generation config '
+                                        'of the model without sampling, beam search and logits processors.')
+    parser.add_argument('--threads', dest='n_threads', type=int, required=False, default=0,
+                        help='The number of intra-op threads for CPU inference (0 means the PyTorch default).')
+    parser.add_argument('--interop-threads', dest='n_interop_threads', type=int, required=False, default=0,
+                        help='The number of inter-op threads for CPU inference (0 means the PyTorch default).')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help=f'Keep the manifest of input files with their sizes, modification times and content '
+                             f'hashes ({FILES_MANIFEST_FNAME}) and rows of every file ({ROWS_DIRNAME} subdirectory) in '
+                             f'the output, and correct only added or changed files, dropping rows of deleted ones.')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='Only substitute coreferent mentions and write the substitution plans into '
+                             f'{PLANS_FNAME}, without the large language model.')
+    parser.add_argument('--hybrid', dest='hybrid', action='store_true',
+                        help='Inflect main entities to the case and number of replaced mentions by rules, and correct '
+                             'by the large language model only samples which cannot be inflected unambiguously.')
+    parser.add_argument('--pipelined', dest='pipelined', action='store_true',
+                        help='Prepare samples, generate corrections and write rows concurrently.')
+    parser.add_argument('--queue-size', dest='queue_size', type=int, required=False, default=8,
+                        help='The capacity of queues between stages of the pipelined mode.')
+    parser.add_argument('--cache', dest='cache_name', type=str, required=False, default='',
+                        help='The path to the SQLite database with cached corrections (no cache if it is empty).')
+    parser.add_argument('--cache-max-entries', dest='cache_max_entries', type=int, required=False, default=0,
+                        help='The maximal number of cached corrections, beyond which the least recently used ones '
+                             'are evicted (0 means no limit).')
+    parser.add_argument('--metrics-json', dest='metrics_json', type=str, required=False, default='',
+                        help='The path to the JSON summary of stage times, token counts, skipped samples and peak '
+                             f'memory (it is {METRICS_FNAME} in the output directory if it is empty).')
+    parser.add_argument('--prometheus-textfile', dest='prometheus_textfile', type=str, required=False, default='',
+                        help='The path to the Prometheus textfile with the same metrics, which is updated at every '
+                             'checkpoint (no textfile if it is empty).')
+    parser.add_argument('--num-shards', dest='num_shards', type=int, required=False, default=1,
+                        help='The number of shards of the input samples, which are prepared independently.')
+    parser.add_argument('--shard-id', dest='shard_id', type=int, required=False, default=0,
+                        help='The shard of the input samples, which is prepared (every num_shards-th input file or '
+                             'substitution plan starting with shard_id).')
+    parser.add_argument('--workers', dest='workers', type=int, required=False, default=1,
+                        help='The number of worker processes, which prepare shards of the dataset in parallel '
+                             f'in the sibling directory of the output with the -{SHARDS_DIRNAME} suffix, before '
+                             f'their merging.')
+    parser.add_argument('--devices', dest='devices', type=str, required=False, default='',
+                        help='The comma-separated list of devices of workers, which is cycled if it is shorter '
+                             'than the number of workers (all workers use --device if it is empty).')
+    parser.add_argument('--output-format', dest='output_format', type=str, required=False, default='csv',
+                        choices=['csv', 'parquet'],
+                        help='The format of the output dataset: one train_data.csv file or train-NNNNN.parquet '
+                             'shards.')
+    parser.add_argument('--rows-per-shard', dest='rows_per_shard', type=int, required=False, default=10000,
+                        help='The number of rows in every Parquet shard.')
     args = parser.parse_args()
 
-    if not torch.cuda.is_available():
-        raise RuntimeError('CUDA is not available')
-    device = 'cuda:0'
+    if args.batch_size < 1:
+        raise ValueError(f'The batch size is wrong! Expected a positive integer, got {args.batch_size}.')
+    if args.bucket_window < 0:
+        raise ValueError(f'The bucket window is wrong! Expected a non-negative integer, got {args.bucket_window}.')
+    if args.max_window_length < 0:
+        raise ValueError(f'The maximal window length is wrong! Expected a non-negative integer, '
+                         f'got {args.max_window_length}.')
+    if args.queue_size < 1:
+        raise ValueError(f'The queue size is wrong! Expected a positive integer, got {args.queue_size}.')
+    if args.num_shards < 1:
+        raise ValueError(f'The number of shards is wrong! Expected a positive integer, got {args.num_shards}.')
+    if (args.shard_id < 0) or (args.shard_id >= args.num_shards):
+        raise ValueError(f'The shard ID is wrong! Expected an integer from 0 to {args.num_shards - 1}, '
+                         f'got {args.shard_id}.')
+    if args.prompt_lookup_num_tokens < 0:
+        raise ValueError(f'The number of prompt lookup tokens is wrong! Expected a non-negative integer, '
+                         f'got {args.prompt_lookup_num_tokens}.')
+    if args.workers < 1:
+        raise ValueError(f'The number of workers is wrong! Expected a positive integer, got {args.workers}.')
+    if (args.workers > 1) and ((args.num_shards > 1) or args.dry_run):
+        raise ValueError('The workers cannot be combined with --num-shards or --dry-run!')
+
+    if args.incremental and (args.resume or args.dry_run or (args.workers > 1) or (args.num_shards > 1)):
+        raise ValueError('The incremental mode cannot be combined with --resume, --dry-run, --workers or '
+                         '--num-shards!')
+    if (not args.dry_run) and (len(args.large_language_model) == 0):
+        raise ValueError('The large language model is not specified!')
 
     input_dataset_path = os.path.normpath(args.input_name)
-    if not os.path.isdir(input_dataset_path):
+    if os.path.isdir(input_dataset_path):
+        n_inputs = len(find_rucoco_files(input_dataset_path))
+        print(f'There are {n_inputs} files are found in {input_dataset_path}.')
+    elif os.path.isfile(input_dataset_path):
+        if args.incremental:
+            raise ValueError(f'The substitution plans "{input_dataset_path}" cannot be processed incrementally!')
+        if args.dry_run:
+            raise ValueError(f'The substitution plans "{input_dataset_path}" cannot be prepared again!')
+        n_inputs = None
+    else:
         raise IOError(f'The directory "{input_dataset_path}" does not exist!')
 
     output_dataset_path = os.path.normpath(args.output_name)
@@ -213,99 +1353,207 @@ def main():
                 raise IOError(f'The directory "{base_dir}" does not exist!')
         os.mkdir(output_dataset_path)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.large_language_model)
+    if args.workers > 1:
+        devices = list(filter(lambda it: len(it) > 0, map(lambda it: it.strip(), args.devices.split(','))))
+        if len(devices) == 0:
+            devices = [args.device]
+        devices = [devices[worker_idx % len(devices)] for worker_idx in range(args.workers)]
+        n_threads = args.n_threads
+        if (n_threads == 0) and all(map(lambda it: it == 'cpu', devices)):
+            # CPU workers share the cores instead of oversubscribing them
+            n_threads = max(1, (os.cpu_count() or 1) // args.workers)
+        shards_dir = get_shards_dir(output_dataset_path)
+        if not os.path.isdir(shards_dir):
+            os.mkdir(shards_dir)
+        commands = make_worker_commands(sys.argv[1:], shards_dir, devices, n_threads,
+                                        args.prometheus_textfile)
+        print(f'{args.workers} workers are started on {devices}.')
+        run_workers(commands)
+        if args.output_format == 'parquet':
+            writer = ParquetDatasetWriter(output_dataset_path, None, args.rows_per_shard)
+        else:
+            writer = CSVDatasetWriter(output_dataset_path)
+        shard_dirs = [command[command.index('--output') + 1] for command in commands]
+        n_rows = merge_datasets(shard_dirs, args.output_format, writer)
+        print(f'There are {n_rows} rows of {args.workers} shards are merged into "{output_dataset_path}".')
+        return
+
+    metrics = RunMetrics(
+        json_fname=os.path.normpath(args.metrics_json) if (len(args.metrics_json) > 0)
+        else os.path.join(output_dataset_path, METRICS_FNAME),
+        prometheus_fname=os.path.normpath(args.prometheus_textfile) if (len(args.prometheus_textfile) > 0) else '',
+        labels={'shard': str(args.shard_id)} if (args.num_shards > 1) else None
+    )
+    source_data = iterate_prepared_samples(input_dataset_path, args.loader_processes, metrics, args.num_shards,
+                                           args.shard_id)
+    if args.dry_run:
+        plans_fname = os.path.join(output_dataset_path, PLANS_FNAME)
+        with metrics.measure('write'):
+            n_plans = save_substitution_plans(plans_fname, tqdm(source_data, total=n_inputs))
+        metrics.export()
+        print(f'There are {n_plans} substitution plans are written into the "{plans_fname}".')
+        return
+
+    if args.incremental:
+        manifest_fname = os.path.join(output_dataset_path, FILES_MANIFEST_FNAME)
+        progress = load_progress(manifest_fname)
+        if (len(progress) > 0) and ((progress.get('input') != input_dataset_path) or
+                                    (progress.get('output_format') != args.output_format)):
+            raise RuntimeError(f'The manifest "{manifest_fname}" does not correspond to {input_dataset_path}.')
+        with metrics.measure('load'):
+            files, new_files, deleted_names = update_file_manifest(find_rucoco_files(input_dataset_path),
+                                                                   progress.get('files', dict()))
+        print(f'{len(new_files)} input files are added or changed, {len(deleted_names)} are deleted, '
+              f'and {len(files)} are not changed.')
+        rows_dir = os.path.join(output_dataset_path, ROWS_DIRNAME)
+        if not os.path.isdir(rows_dir):
+            os.mkdir(rows_dir)
+        # rows of deleted and changed files are dropped before correction of the new ones
+        writer = IncrementalDatasetWriter(rows_dir, files, new_files)
+        progress = {
+            'input': input_dataset_path,
+            'output_format': args.output_format,
+            'processed_samples': 0
+        }
+        progress.update(writer.state)
+        save_progress(manifest_fname, progress)
+        if len(new_files) == 0:
+            with metrics.measure('write'):
+                n_rows, output_fname = assemble_dataset(output_dataset_path, rows_dir, writer.files,
+                                                        args.output_format, args.rows_per_shard)
+            metrics.export()
+            print(f'There are {n_rows} are written into the "{output_fname}".')
+            return
+        source_data = iterate_file_samples([it[0] for it in new_files], args.loader_processes, metrics)
+        n_inputs = len(new_files)
+
+    if args.backend == 'openai':
+        backend = OpenAICorrectionBackend(args.api_base, args.large_language_model, args.api_key,
+                                          max_concurrency=args.max_concurrency, max_retries=args.max_retries,
+                                          metrics=metrics)
+        print(f'LLM {args.large_language_model} is served by {args.api_base}.')
+    else:
+        import torch
+
+        device = args.device
+        if device.startswith('cuda') and (not torch.cuda.is_available()):
+            raise RuntimeError('CUDA is not available')
+        configure_threads(args.n_threads, args.n_interop_threads)
+
+        with metrics.measure('setup'):
+            tokenizer, model = load_model(args.large_language_model, device, args.dtype)
+        print(f'LLM is loaded from {args.large_language_model} to {device}.')
+        if args.no_prefix_cache:
+            prompt_prefix = None
+        else:
+            with metrics.measure('setup'):
+                prompt_prefix = encode_prompt_prefix(tokenizer, model, device)
+        if prompt_prefix is None:
+            print('The few-shot prompt prefix is not cached, so full prompts are encoded.')
+        else:
+            print(f'The few-shot prompt prefix of {prompt_prefix[1].shape[1]} tokens is encoded and cached.')
+        backend = HFCorrectionBackend(tokenizer, model, device, prompt_prefix, metrics,
+                                      args.prompt_lookup_num_tokens)
+    if args.bucket_window > 0:
+        bucketed_backend = BucketedCorrectionBackend(backend, args.batch_size)
+        backend = bucketed_backend
+        batch_size = max(args.bucket_window, args.batch_size)
+    else:
+        bucketed_backend = None
+        batch_size = args.batch_size
+    if args.max_window_length > 0:
+        # length-bucketed batches of windows are formed by the bucketed backend, if it is used
+        windowed_backend = WindowedCorrectionBackend(backend, args.max_window_length,
+                                                     0 if (bucketed_backend is not None) else args.batch_size)
+        backend = windowed_backend
+    else:
+        windowed_backend = None
+    if len(args.cache_name) > 0:
+        cache = CorrectionCache(os.path.normpath(args.cache_name), args.cache_max_entries)
+        print(f'There are {len(cache)} corrections in the cache "{cache.db_fname}".')
+        backend = CachedCorrectionBackend(backend, cache)
+    else:
+        cache = None
+
+    if not args.incremental:
+        manifest_fname = os.path.join(output_dataset_path, 'progress.json')
+        progress = load_progress(manifest_fname) if args.resume else dict()
+        if len(progress) > 0:
+            if (progress.get('input') != input_dataset_path) or (progress.get('n_inputs') != n_inputs) or \
+                    (progress.get('output_format') != args.output_format) or \
+                    (progress.get('num_shards', 1) != args.num_shards) or \
+                    (progress.get('shard_id', 0) != args.shard_id):
+                raise RuntimeError(f'The checkpoint "{manifest_fname}" does not correspond to {input_dataset_path}.')
+            print(f'{progress["processed_samples"]} samples are skipped, because they are processed already.')
+            writer_state = progress
+        else:
+            progress = {
+                'input': input_dataset_path,
+                'n_inputs': n_inputs,
+                'output_format': args.output_format,
+                'num_shards': args.num_shards,
+                'shard_id': args.shard_id,
+                'processed_samples': 0,
+                'n_rows': 0
+            }
+            writer_state = None
+        if args.output_format == 'parquet':
+            writer = ParquetDatasetWriter(output_dataset_path, writer_state, args.rows_per_shard)
+            output_fname = os.path.join(output_dataset_path, 'train-*.parquet')
+        else:
+            # shards are merged by sample indices, so they are written with them
+            writer = CSVDatasetWriter(output_dataset_path, writer_state, with_sample_idx=(args.num_shards > 1))
+            output_fname = writer.output_fname
+        progress.update(writer.state)
+    if args.hybrid:
+        from linguistic_utils.linguistic_utils import initialize_nlp, inflect_substitutions
+
+        with metrics.measure('setup'):
+            nlp, morph = initialize_nlp()
+
+        def inflect(source_text: str, substitutions: List[Tuple[int, int, int, int, str]]) -> Optional[str]:
+            return inflect_substitutions(source_text, substitutions, nlp, morph)
+    else:
+        inflect = None
     try:
-        model = AutoModelForCausalLM.from_pretrained(args.large_language_model, torch_dtype=torch.bfloat16).to(device)
-    except:
-        model = AutoModelForCausalLM.from_pretrained(args.large_language_model, torch_dtype=torch.float16).to(device)
-    model.eval()
-    print(f'LLM is loaded from {args.large_language_model}.')
-
-    source_data = load_rucoco(input_dataset_path)
-    print(f'There are {len(source_data)} samples are loaded from {input_dataset_path}.')
-
-    n_rows = 0
-    output_fname = os.path.join(output_dataset_path, 'train_data.csv')
-    with codecs.open(output_fname, mode='w', encoding='utf-8', buffering=0) as fp:
-        data_writer = csv.writer(fp, delimiter=',', quotechar='"')
-        data_writer.writerow(['source_text', 'text_without_coreference'])
-        for sample_idx, (text, coreference_chains) in enumerate(tqdm(source_data)):
-            found_idx = text.find('Источник: ')
-            if found_idx >= 0:
-                prepared_text = text[:found_idx].rstrip()
-            else:
-                prepared_text = text
-            is_valid = True
-            for cur_chain in coreference_chains:
-                for entity_start, entity_end in cur_chain:
-                    if entity_end > len(prepared_text):
-                        is_valid = False
-                        break
-                if not is_valid:
-                    break
-            if is_valid:
-                substitutions = []
-                for cur_chain in coreference_chains:
-                    entities = []
-                    for entity_start, entity_end in cur_chain:
-                        entities.append(prepared_text[entity_start:entity_end])
-                    if len(entities) < 2:
-                        is_valid = False
-                    else:
-                        entities.sort(key=lambda it: (-len(it), it))
-                        main_entity = ''
-                        for cur_entity in entities:
-                            if (len(cur_entity) > 1) and cur_entity.isupper():
-                                main_entity = cur_entity
-                                break
-                        if len(main_entity) == 0:
-                            main_entity = entities[0]
-                        if len(main_entity) < 2:
-                            warnings.warn(f'Main entity in the sample {sample_idx} is not found.')
-                            is_valid = False
-                        else:
-                            for entity_start, entity_end in cur_chain:
-                                substitutions.append((entity_start, entity_end, main_entity))
-                    del entities
-                    if not is_valid:
-                        break
-                if is_valid:
-                    if len(substitutions) > 0:
-                        substitutions.sort(key=lambda it: (it[0], it[1], len(it[2])))
-                        filtered_substitutions = []
-                        filled = [0 for _ in range(len(prepared_text))]
-                        for entity_start, entity_end, entity_text in substitutions:
-                            ok = True
-                            for char_idx in range(entity_start, entity_end):
-                                if filled[char_idx] != 0:
-                                    ok = False
-                                    break
-                            if ok:
-                                for char_idx in range(entity_start, entity_end):
-                                    filled[char_idx] = 1
-                                filtered_substitutions.append((entity_start, entity_end, entity_text))
-                        if len(filtered_substitutions) < 2:
-                            is_valid = False
-                        if is_valid:
-                            n_rows += 1
-                            new_text = prepared_text[0:substitutions[0][0]]
-                            new_text += substitutions[0][2]
-                            prev_entity_end = substitutions[0][1]
-                            for entity_idx in range(1, len(substitutions)):
-                                cur_entity_start = substitutions[entity_idx][0]
-                                cur_entity_end = substitutions[entity_idx][1]
-                                new_text += prepared_text[prev_entity_end:cur_entity_start]
-                                new_text += substitutions[entity_idx][2]
-                                prev_entity_end = cur_entity_end
-                            new_text += prepared_text[substitutions[-1][1]:]
-                            corrected_text = correct_text(new_text.strip(), tokenizer, model, device)
-                            data_writer.writerow([prepared_text.strip(), corrected_text.strip()])
-                        else:
-                            warnings.warn(f'Some entities in the sample {sample_idx} are overlapped.')
-                del substitutions
-            else:
-                warnings.warn(f'Some entities in the sample {sample_idx} have a wrong bounds.')
+        n_rows = write_dataset(source_data, n_inputs, backend, writer, manifest_fname, progress,
+                               batch_size, args.pipelined, args.queue_size, metrics, inflect)
+        if args.incremental:
+            with metrics.measure('write'):
+                n_rows, output_fname = assemble_dataset(output_dataset_path, rows_dir, writer.files,
+                                                        args.output_format, args.rows_per_shard)
+        if inflect is not None:
+            n_bypassed = metrics.counters.get('bypassed_samples', 0)
+            n_corrected = metrics.counters.get('corrected_samples', 0)
+            print(f'{n_bypassed} of {n_bypassed + n_corrected} samples are inflected by rules without the LLM.')
+        if windowed_backend is not None:
+            print(f'{windowed_backend.n_texts} texts are corrected by {windowed_backend.n_windows} windows.')
+            metrics.increment('windows', windowed_backend.n_windows)
+        if bucketed_backend is not None:
+            print(f'The padding efficiency is {round(100.0 * bucketed_backend.padding_efficiency, 1)}% '
+                  f'({round(100.0 * bucketed_backend.unscheduled_padding_efficiency, 1)}% without bucketing).')
+            metrics.increment('bucketed_tokens', bucketed_backend.n_tokens)
+            metrics.increment('bucketed_padded_tokens', bucketed_backend.n_padded_tokens)
+        if cache is not None:
+            cache_stats = cache.stats()
+            print(f'The cache hit rate is {round(100.0 * cache_stats["hit_rate"], 1)}% '
+                  f'({cache_stats["hits"]} hits, {cache_stats["misses"]} misses, '
+                  f'{cache_stats["evicted"]} evicted, {cache_stats["entries"]} entries).')
+            metrics.increment('cache_hits', cache_stats['hits'])
+            metrics.increment('cache_misses', cache_stats['misses'])
+        if args.prompt_lookup_num_tokens > 0:
+            summary = metrics.summary()
+            print(f'The draft acceptance rate is {round(100.0 * summary["draft_acceptance_rate"], 1)}% '
+                  f'({summary["counters"].get("accepted_draft_tokens", 0)} of '
+                  f'{summary["counters"].get("draft_tokens", 0)} draft tokens are accepted in '
+                  f'{summary["counters"].get("decoding_steps", 0)} decoding steps).')
+    finally:
+        backend.close()
+    summary = metrics.export()
     print(f'There are {n_rows} are written into the "{output_fname}".')
+    print(f'{round(summary["wall_seconds"], 1)} seconds, {round(summary["output_tokens_per_sec"], 1)} generated '
+          f'tokens per second, skipped samples: {summary["skipped_samples"]}. The metrics are saved into '
+          f'the "{metrics.json_fname}".')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+from typing import Callable, List, Optional, Tuple
+import warnings
+
+from io_utils.io_utils import IntervalIndex
+
+
+def select_main_entity(entities: List[str]) -> str:
+    entities = sorted(entities, key=lambda it: (-len(it), it))
+    main_entity = ''
+    for cur_entity in entities:
+        if (len(cur_entity) > 1) and cur_entity.isupper():
+            main_entity = cur_entity
+            break
+    if len(main_entity) == 0:
+        main_entity = entities[0]
+    return main_entity
+
+
+def ignore_skipping(reason: str):
+    pass
+
+
+def build_substitutions(text: str, coreference_chains: List[List[Tuple[int, int]]], sample_idx: int,
+                        on_skip: Optional[Callable[[str], None]] = None
+                        ) -> Optional[Tuple[str, List[Tuple[int, int, str]]]]:
+    """ Select substitutions of coreferent mentions by main entities of their chains.
+
+    If the sample is skipped, then None is returned, and the reason of skipping is passed into on_skip.
+    """
+    if on_skip is None:
+        on_skip = ignore_skipping
+    found_idx = text.find('Источник: ')
+    if found_idx >= 0:
+        prepared_text = text[:found_idx].rstrip()
+    else:
+        prepared_text = text
+    for cur_chain in coreference_chains:
+        for entity_start, entity_end in cur_chain:
+            if entity_end > len(prepared_text):
+                warnings.warn(f'Some entities in the sample {sample_idx} have a wrong bounds.')
+                on_skip('wrong_bounds')
+                return None
+    substitutions = []
+    for cur_chain in coreference_chains:
+        if len(cur_chain) < 2:
+            on_skip('single_mention_chain')
+            return None
+        main_entity = select_main_entity([prepared_text[it[0]:it[1]] for it in cur_chain])
+        if len(main_entity) < 2:
+            warnings.warn(f'Main entity in the sample {sample_idx} is not found.')
+            on_skip('main_entity_not_found')
+            return None
+        for entity_start, entity_end in cur_chain:
+            substitutions.append((entity_start, entity_end, main_entity))
+    if len(substitutions) == 0:
+        on_skip('no_substitutions')
+        return None
+    substitutions.sort(key=lambda it: (it[0], it[1], len(it[2])))
+    filtered_substitutions = []
+    filled = IntervalIndex()
+    for entity_start, entity_end, entity_text in substitutions:
+        if filled.add(entity_start, entity_end):
+            filtered_substitutions.append((entity_start, entity_end, entity_text))
+    if len(filtered_substitutions) < 2:
+        warnings.warn(f'Some entities in the sample {sample_idx} are overlapped.')
+        on_skip('overlapped_substitutions')
+        return None
+    return prepared_text, filtered_substitutions
+
+
+def apply_substitutions(prepared_text: str,
+                        substitutions: List[Tuple[int, int, str]]) -> Tuple[str, List[Tuple[int, int]]]:
+    parts = []
+    new_bounds = []
+    prev_entity_end = 0
+    new_text_length = 0
+    for entity_start, entity_end, entity_text in substitutions:
+        parts.append(prepared_text[prev_entity_end:entity_start])
+        new_text_length += entity_start - prev_entity_end
+        parts.append(entity_text)
+        new_bounds.append((new_text_length, new_text_length + len(entity_text)))
+        new_text_length += len(entity_text)
+        prev_entity_end = entity_end
+    parts.append(prepared_text[prev_entity_end:])
+    return ''.join(parts), new_bounds
+
+
+def prepare_sample_with_plan(text: str, coreference_chains: List[List[Tuple[int, int]]], sample_idx: int,
+                             on_skip: Optional[Callable[[str], None]] = None
+                             ) -> Optional[Tuple[str, str, List[Tuple[int, int, int, int, str]]]]:
+    res = build_substitutions(text, coreference_chains, sample_idx, on_skip)
+    if res is None:
+        return None
+    prepared_text, substitutions = res
+    new_text, new_bounds = apply_substitutions(prepared_text, substitutions)
+    # offsets are given relative to the stripped texts, which are written into the dataset
+    source_shift = len(prepared_text) - len(prepared_text.lstrip())
+    target_shift = len(new_text) - len(new_text.lstrip())
+    plan = [
+        (entity_start - source_shift, entity_end - source_shift, new_start - target_shift, new_end - target_shift,
+         entity_text)
+        for (entity_start, entity_end, entity_text), (new_start, new_end) in zip(substitutions, new_bounds)
+    ]
+    return prepared_text.strip(), new_text.strip(), plan
+
+
+def prepare_sample(text: str, coreference_chains: List[List[Tuple[int, int]]],
+                   sample_idx: int) -> Optional[Tuple[str, str]]:
+    res = prepare_sample_with_plan(text, coreference_chains, sample_idx)
+    if res is None:
+        return None
+    return res[0], res[1]
@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+import unittest
+
+try:
+    from cache_utils.cache_utils import CorrectionCache, calculate_key, calculate_namespace
+except:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from cache_utils.cache_utils import CorrectionCache, calculate_key, calculate_namespace
+
+
+class TestCalculateKey(unittest.TestCase):
+    def test_calculate_key(self):
+        namespace = calculate_namespace({'model': 'a', 'examples': [('b', 'c')]})
+        self.assertEqual(namespace, calculate_namespace({'examples': [('b', 'c')], 'model': 'a'}))
+        self.assertNotEqual(namespace, calculate_namespace({'model': 'a', 'examples': [('b', 'd')]}))
+        self.assertEqual(calculate_key(namespace, 'текст'), calculate_key(namespace, 'текст'))
+        self.assertNotEqual(calculate_key(namespace, 'текст'), calculate_key(namespace, 'текст.'))
+        other_namespace = calculate_namespace({'model': 'b', 'examples': [('b', 'c')]})
+        self.assertNotEqual(calculate_key(namespace, 'текст'), calculate_key(other_namespace, 'текст'))
+
+
+class TestCorrectionCache(unittest.TestCase):
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_fname = os.path.join(temp_dir, 'cache.sqlite')
+            cache = CorrectionCache(db_fname)
+            self.assertIsNone(cache.get('1'))
+            cache.put_many([('1', 'один'), ('2', 'два')])
+            cache.close()
+            cache = CorrectionCache(db_fname)
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.get_many(['2', '3', '1', '2']), {'1': 'один', '2': 'два'})
+            self.assertEqual(cache.hits, 3)
+            self.assertEqual(cache.misses, 1)
+            self.assertAlmostEqual(cache.hit_rate, 0.75)
+            cache.close()
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = CorrectionCache(os.path.join(temp_dir, 'cache.sqlite'), max_entries=2)
+            cache.put('1', 'один')
+            cache.put('2', 'два')
+            self.assertEqual(cache.get('1'), 'один')
+            cache.put('3', 'три')
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get('2'))
+            self.assertEqual(cache.get('1'), 'один')
+            self.assertEqual(cache.get('3'), 'три')
+            self.assertEqual(cache.evict(1), 1)
+            stats = cache.stats()
+            self.assertEqual(stats['evicted'], 2)
+            self.assertEqual(stats['entries'], 1)
+            cache.close()
+
+    def test_wrong_size(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.assertRaises(ValueError):
+                _ = CorrectionCache(os.path.join(temp_dir, 'cache.sqlite'), max_entries=-1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,12 +1,33 @@
+import csv
+import glob
 import os
 import sys
+import tempfile
+import types
 import unittest
+import warnings
 
 try:
-    from io_utils.io_utils import load_rucoco, find_entity
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    from io_utils.io_utils import load_rucoco, find_entity, iterate_rucoco, find_rucoco_files
+    from io_utils.io_utils import load_progress, save_progress
+    from io_utils.io_utils import IntervalIndex, find_overlapped_interval
+    from io_utils.io_utils import save_substitution_plans, iterate_substitution_plans
+    from io_utils.io_utils import CSVDatasetWriter, ParquetDatasetWriter, merge_datasets
+    from io_utils.io_utils import IncrementalDatasetWriter, iterate_incremental_rows, update_file_manifest
 except:
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-    from io_utils.io_utils import load_rucoco, find_entity
+    from io_utils.io_utils import load_rucoco, find_entity, iterate_rucoco, find_rucoco_files
+    from io_utils.io_utils import load_progress, save_progress
+    from io_utils.io_utils import IntervalIndex, find_overlapped_interval
+    from io_utils.io_utils import save_substitution_plans, iterate_substitution_plans
+    from io_utils.io_utils import CSVDatasetWriter, ParquetDatasetWriter, merge_datasets
+    from io_utils.io_utils import IncrementalDatasetWriter, iterate_incremental_rows, update_file_manifest
 
 
 class TestFindEntity(unittest.TestCase):
@@ -51,6 +72,46 @@ class TestFindEntity(unittest.TestCase):
         self.assertEqual(found_idx, true_entity_idx)
 
 
+class TestIntervalIndex(unittest.TestCase):
+    def test_find_01(self):
+        index = IntervalIndex([(0, 10), (45, 55), (12, 34)])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.find(4), 0)
+        self.assertEqual(index.find(9), 0)
+        self.assertEqual(index.find(12), 1)
+        self.assertEqual(index.find(50), 2)
+
+    def test_find_02(self):
+        index = IntervalIndex([(0, 10), (45, 55), (12, 34)])
+        self.assertEqual(index.find(11), -1)
+        self.assertEqual(index.find(34), -1)
+        self.assertEqual(index.find(55), -1)
+        self.assertEqual(index.find(-1), -1)
+
+    def test_add(self):
+        index = IntervalIndex()
+        self.assertTrue(index.add(12, 34))
+        self.assertTrue(index.add(0, 10))
+        self.assertFalse(index.add(5, 15))
+        self.assertFalse(index.add(33, 40))
+        self.assertFalse(index.add(0, 100))
+        self.assertTrue(index.add(10, 12))
+        self.assertTrue(index.add(34, 40))
+        self.assertEqual(index.starts, [0, 10, 12, 34])
+        self.assertEqual(index.ends, [10, 12, 34, 40])
+
+
+class TestFindOverlappedInterval(unittest.TestCase):
+    def test_find_overlapped_interval_01(self):
+        self.assertIsNone(find_overlapped_interval([(0, 10), (45, 55), (12, 34), (10, 12)]))
+
+    def test_find_overlapped_interval_02(self):
+        self.assertEqual(find_overlapped_interval([(0, 10), (45, 55), (12, 34), (30, 40)]), (30, 40))
+
+    def test_find_overlapped_interval_03(self):
+        self.assertEqual(find_overlapped_interval([(0, 50), (45, 55), (12, 34)]), (12, 34))
+
+
 class TestLoadRuCoCo(unittest.TestCase):
     def test_loading(self):
         dataset_name = os.path.join(os.path.dirname(__file__), 'testdata', 'dataset')
@@ -76,6 +137,278 @@ class TestLoadRuCoCo(unittest.TestCase):
                     self.assertLessEqual(it[1], len(sample[0]))
                     self.assertEqual(sample[0][it[0]:it[1]], sample[0][it[0]:it[1]].strip())
 
+    def test_iterating(self):
+        dataset_name = os.path.join(os.path.dirname(__file__), 'testdata', 'dataset')
+        res = iterate_rucoco(dataset_name)
+        self.assertIsInstance(res, types.GeneratorType)
+        self.assertEqual(list(res), load_rucoco(dataset_name))
+
+    def test_loading_in_parallel(self):
+        dataset_name = os.path.join(os.path.dirname(__file__), 'testdata', 'dataset')
+        self.assertEqual(load_rucoco(dataset_name, n_processes=2), load_rucoco(dataset_name))
+
+    def test_skipping(self):
+        dataset_name = os.path.join(os.path.dirname(__file__), 'testdata', 'dataset')
+        reasons = []
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            samples = list(iterate_rucoco(dataset_name, on_skip=reasons.append))
+        self.assertEqual(reasons, ['overlapped_mentions'] * (len(find_rucoco_files(dataset_name)) - len(samples)))
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manifest_fname = os.path.join(self.temp_dir.name, 'progress.json')
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_load_progress_01(self):
+        res = load_progress(self.manifest_fname)
+        self.assertIsInstance(res, dict)
+        self.assertEqual(len(res), 0)
+
+    def test_load_progress_02(self):
+        progress = {'input': 'Корпус', 'processed_samples': 3, 'n_rows': 2, 'output_size': 1024}
+        save_progress(self.manifest_fname, progress)
+        self.assertFalse(os.path.isfile(self.manifest_fname + '.tmp'))
+        res = load_progress(self.manifest_fname)
+        self.assertIsInstance(res, dict)
+        self.assertEqual(res, progress)
+        progress['processed_samples'] = 4
+        save_progress(self.manifest_fname, progress)
+        self.assertEqual(load_progress(self.manifest_fname), progress)
+
+
+class TestSubstitutionPlans(unittest.TestCase):
+    def test_saving_and_loading(self):
+        plans = [
+            (0, 'Газета пишет, что она права.', 'Газета пишет, что Газета права.',
+             [(0, 6, 0, 6, 'Газета'), (18, 21, 18, 24, 'Газета')]),
+            (3, 'РФ - это Россия.', 'РФ - это РФ.', [(0, 2, 0, 2, 'РФ'), (9, 15, 9, 11, 'РФ')])
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fname = os.path.join(temp_dir, 'substitutions.jsonl')
+            self.assertEqual(save_substitution_plans(fname, iter(plans)), len(plans))
+            res = iterate_substitution_plans(fname)
+            self.assertIsInstance(res, types.GeneratorType)
+            self.assertEqual(list(res), plans)
+
+
+def make_rows(first_sample_idx: int, n_rows: int) -> list:
+    return [
+        {
+            'sample_idx': sample_idx,
+            'source_text': f'Газета пишет, что она права ({sample_idx}).',
+            'text_with_substitutions': f'Газета пишет, что Газета права ({sample_idx}).',
+            'n_substitutions': 2,
+            'text_without_coreference': f'Газета пишет, что газета права ({sample_idx}).'
+        }
+        for sample_idx in range(first_sample_idx, first_sample_idx + n_rows)
+    ]
+
+
+class TestCSVDatasetWriter(unittest.TestCase):
+    def test_writing_and_resuming(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = CSVDatasetWriter(temp_dir)
+            self.assertTrue(writer.write(make_rows(0, 3)))
+            state = writer.state
+            self.assertEqual(state['n_rows'], 3)
+            self.assertEqual(state['processed_samples'], 3)
+            self.assertGreater(state['output_size'], 0)
+            self.assertTrue(writer.write(make_rows(3, 2)))
+            writer.close()
+            writer = CSVDatasetWriter(temp_dir, state)
+            self.assertTrue(writer.write(make_rows(3, 3)))
+            writer.close()
+            self.assertEqual(writer.n_rows, 6)
+            with open(writer.output_fname, mode='r', encoding='utf-8', newline='') as fp:
+                rows = list(csv.reader(fp))
+        self.assertEqual(rows[0], ['source_text', 'text_without_coreference'])
+        self.assertEqual(rows[1:], [[it['source_text'], it['text_without_coreference']] for it in make_rows(0, 6)])
+
+
+@unittest.skipIf(pyarrow is None, 'The pyarrow package is not installed.')
+class TestParquetDatasetWriter(unittest.TestCase):
+    def read_shards(self, output_dir: str):
+        shard_names = sorted(glob.glob(os.path.join(output_dir, 'train-*.parquet')))
+        rows = []
+        for cur_name in shard_names:
+            rows += pyarrow.parquet.read_table(cur_name).to_pylist()
+        return list(map(os.path.basename, shard_names)), rows
+
+    def test_writing_and_resuming(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = ParquetDatasetWriter(temp_dir, rows_per_shard=2)
+            self.assertTrue(writer.write(make_rows(0, 1)))
+            self.assertTrue(writer.write(make_rows(1, 2)))
+            state = writer.state
+            self.assertEqual(state['n_shards'], 1)
+            self.assertEqual(state['n_rows'], 3)
+            self.assertEqual(state['processed_samples'], 3)
+            self.assertGreater(state['spill_size'], 0)
+            self.assertTrue(writer.write(make_rows(3, 2)))
+            writer = ParquetDatasetWriter(temp_dir, state, rows_per_shard=2)
+            self.assertEqual(len(glob.glob(os.path.join(temp_dir, 'train-*.parquet'))), 1)
+            writer.write(make_rows(3, 2))
+            writer.close()
+            self.assertEqual(writer.n_rows, 5)
+            shard_names, rows = self.read_shards(temp_dir)
+            self.assertEqual(glob.glob(os.path.join(temp_dir, '*.jsonl')), [])
+        self.assertEqual(shard_names, ['train-00000.parquet', 'train-00001.parquet', 'train-00002.parquet'])
+        self.assertEqual(rows, make_rows(0, 5))
+
+    def test_foreign_files(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            foreign_names = ['train-old.parquet', 'train-00001.parquet.bak', 'train-1a.partial.jsonl']
+            for cur_name in foreign_names:
+                with open(os.path.join(temp_dir, cur_name), mode='w') as fp:
+                    fp.write('old')
+            writer = ParquetDatasetWriter(temp_dir, rows_per_shard=2)
+            writer.write(make_rows(0, 3))
+            writer = ParquetDatasetWriter(temp_dir, writer.state, rows_per_shard=2)
+            writer.close()
+            self.assertEqual(sorted(os.listdir(temp_dir)), sorted(foreign_names + ['train-00000.parquet',
+                                                                                   'train-00001.parquet']))
+
+    def test_resuming_before_shard(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = ParquetDatasetWriter(temp_dir, rows_per_shard=10)
+            self.assertTrue(writer.write(make_rows(0, 3)))
+            state = writer.state
+            self.assertEqual(state['n_shards'], 0)
+            # the process is killed after the next batch, which is not checkpointed
+            self.assertTrue(writer.write(make_rows(3, 2)))
+            del writer
+            writer = ParquetDatasetWriter(temp_dir, state, rows_per_shard=10)
+            self.assertEqual(writer.n_rows, 3)
+            self.assertEqual(writer.buffer, make_rows(0, 3))
+            writer.write(make_rows(3, 4))
+            writer.close()
+            shard_names, rows = self.read_shards(temp_dir)
+        self.assertEqual(shard_names, ['train-00000.parquet'])
+        self.assertEqual(rows, make_rows(0, 7))
+
+    def test_resuming_after_shard(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = ParquetDatasetWriter(temp_dir, rows_per_shard=4)
+            self.assertTrue(writer.write(make_rows(0, 3)))
+            state = writer.state
+            # the process is killed after the shard with unsaved rows is written
+            self.assertTrue(writer.write(make_rows(3, 3)))
+            self.assertEqual(writer.n_shards, 1)
+            del writer
+            writer = ParquetDatasetWriter(temp_dir, state, rows_per_shard=4)
+            self.assertEqual(writer.buffer, make_rows(0, 3))
+            self.assertEqual(glob.glob(os.path.join(temp_dir, 'train-*.parquet')), [])
+            writer.write(make_rows(3, 2))
+            state = writer.state
+            # the process is killed after closing, before the final checkpoint is saved
+            writer.close()
+            writer = ParquetDatasetWriter(temp_dir, state, rows_per_shard=4)
+            writer.close()
+            self.assertEqual(writer.n_rows, 5)
+            shard_names, rows = self.read_shards(temp_dir)
+        self.assertEqual(shard_names, ['train-00000.parquet', 'train-00001.parquet'])
+        self.assertEqual(rows, make_rows(0, 5))
+
+
+class TestMergeDatasets(unittest.TestCase):
+    def test_merging(self):
+        rows = make_rows(0, 7)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_dirs = []
+            for shard_id in range(3):
+                shard_dirs.append(os.path.join(temp_dir, f'shard-{shard_id}'))
+                os.mkdir(shard_dirs[-1])
+                writer = CSVDatasetWriter(shard_dirs[-1], with_sample_idx=True)
+                writer.write(rows[shard_id::3])
+                writer.close()
+            output_dir = os.path.join(temp_dir, 'merged')
+            os.mkdir(output_dir)
+            writer = CSVDatasetWriter(output_dir)
+            self.assertEqual(merge_datasets(shard_dirs, 'csv', writer, batch_size=2), 7)
+            with open(writer.output_fname, mode='r', encoding='utf-8', newline='') as fp:
+                merged_rows = list(csv.reader(fp))
+        self.assertEqual(merged_rows[1:], [[it['source_text'], it['text_without_coreference']] for it in rows])
+
+    def test_unordered_shard(self):
+        rows = make_rows(0, 3)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_dir = os.path.join(temp_dir, 'shard')
+            os.mkdir(shard_dir)
+            writer = CSVDatasetWriter(shard_dir, with_sample_idx=True)
+            writer.write(rows[::-1])
+            writer.close()
+            with self.assertRaises(IOError):
+                merge_datasets([shard_dir], 'csv', CSVDatasetWriter(temp_dir))
+
+    def test_shard_without_indices(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_dir = os.path.join(temp_dir, 'shard')
+            os.mkdir(shard_dir)
+            writer = CSVDatasetWriter(shard_dir)
+            writer.write(make_rows(0, 3))
+            writer.close()
+            with self.assertRaises(IOError):
+                merge_datasets([shard_dir], 'csv', CSVDatasetWriter(temp_dir))
+
+
+class TestIncrementalDataset(unittest.TestCase):
+    def test_update_file_manifest(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data_files = [os.path.join(temp_dir, f'{idx}.json') for idx in range(3)]
+            for cur_fname in data_files:
+                with open(cur_fname, mode='w', encoding='utf-8') as fp:
+                    fp.write(os.path.basename(cur_fname))
+            unchanged_files, new_files, deleted_names = update_file_manifest(data_files, dict())
+            self.assertEqual(unchanged_files, dict())
+            self.assertEqual([it[0] for it in new_files], data_files)
+            self.assertEqual(deleted_names, [])
+            files = {os.path.basename(cur_fname): dict(entry, n_rows=1) for cur_fname, entry in new_files}
+            # the first file is touched, the second one is changed, the third one is deleted, and the fourth is added
+            os.utime(data_files[0], ns=(0, 0))
+            with open(data_files[1], mode='w', encoding='utf-8') as fp:
+                fp.write('changed')
+            os.remove(data_files[2])
+            data_files[2] = os.path.join(temp_dir, '3.json')
+            with open(data_files[2], mode='w', encoding='utf-8') as fp:
+                fp.write('added')
+            unchanged_files, new_files, deleted_names = update_file_manifest(data_files, files)
+        self.assertEqual(list(unchanged_files.keys()), ['0.json'])
+        self.assertEqual(unchanged_files['0.json']['mtime_ns'], 0)
+        self.assertEqual(unchanged_files['0.json']['n_rows'], 1)
+        self.assertEqual([os.path.basename(it[0]) for it in new_files], ['1.json', '3.json'])
+        self.assertNotEqual(new_files[0][1]['sha256'], files['1.json']['sha256'])
+        self.assertEqual(deleted_names, ['2.json'])
+
+    def test_writing(self):
+        rows = make_rows(0, 4)
+        entry = {'size': 1, 'mtime_ns': 1, 'sha256': ''}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            new_files = [(f'{idx}.json', entry) for idx in range(4)]
+            writer = IncrementalDatasetWriter(temp_dir, dict(), new_files)
+            # the sample of the third file is skipped
+            self.assertTrue(writer.write(rows[0:2]))
+            self.assertEqual(sorted(writer.state['files'].keys()), ['0.json', '1.json'])
+            self.assertTrue(writer.write([rows[3]]))
+            writer.close()
+            files = writer.files
+            self.assertEqual(writer.n_rows, 3)
+            self.assertEqual([files[f'{idx}.json']['n_rows'] for idx in range(4)], [1, 1, 0, 1])
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['0.json.jsonl', '1.json.jsonl', '3.json.jsonl'])
+            # the second file is deleted
+            del files['1.json']
+            writer = IncrementalDatasetWriter(temp_dir, files, [])
+            writer.close()
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['0.json.jsonl', '3.json.jsonl'])
+            merged_rows = list(iterate_incremental_rows(temp_dir, writer.files))
+        expected_rows = [rows[0], rows[3]]
+        expected_rows[1] = dict(expected_rows[1], sample_idx=1)
+        self.assertEqual(merged_rows, expected_rows)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
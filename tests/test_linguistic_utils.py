@@ -1,18 +1,30 @@
 import os
 import sys
+import tempfile
 import unittest
 
+from pymorphy3 import MorphAnalyzer
+import spacy
+from spacy.tokens import Doc
 from pymorphy3.analyzer import Parse
 
 try:
     from linguistic_utils.linguistic_utils import parse_text, find_best_parsing
     from linguistic_utils.linguistic_utils import find_main_token, inflect_subphrase
-    from linguistic_utils.linguistic_utils import initialize_nlp
+    from linguistic_utils.linguistic_utils import initialize_nlp, parse_texts, CachedMorphAnalyzer
+    from linguistic_utils.linguistic_utils import parse_text_with_doc, find_main_token_in_doc
+    from linguistic_utils.linguistic_utils import list_nlp_components, find_token_by_character_index
+    from linguistic_utils.linguistic_utils import parse_doc, parse_doc_as_table, TokenTable
+    from linguistic_utils.linguistic_utils import inflect_subphrases, inflect_substitutions
 except:
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from linguistic_utils.linguistic_utils import parse_text, find_best_parsing
     from linguistic_utils.linguistic_utils import find_main_token, inflect_subphrase
-    from linguistic_utils.linguistic_utils import initialize_nlp
+    from linguistic_utils.linguistic_utils import initialize_nlp, parse_texts, CachedMorphAnalyzer
+    from linguistic_utils.linguistic_utils import parse_text_with_doc, find_main_token_in_doc
+    from linguistic_utils.linguistic_utils import list_nlp_components, find_token_by_character_index
+    from linguistic_utils.linguistic_utils import parse_doc, parse_doc_as_table, TokenTable
+    from linguistic_utils.linguistic_utils import inflect_subphrases, inflect_substitutions
 
 
 class TestLinguisticUtils(unittest.TestCase):
@@ -55,6 +67,29 @@ class TestLinguisticUtils(unittest.TestCase):
             self.assertEqual(val[1], true_token_bounds[idx][1])
             self.assertEqual(val[2].normal_form, true_lemmas[idx])
 
+    def test_parse_texts(self):
+        texts = [
+            'Новосибирский государственный университет находится в Академгородке.',
+            'В Новосибирском государственном университете учится много студентов.',
+            'Институт теплофизики Сибирского отделения РАН'
+        ]
+        for n_process in (1, 2):
+            parsed = parse_texts(texts, self.nlp, self.morph, batch_size=2, n_process=n_process)
+            self.assertIsInstance(parsed, list)
+            self.assertEqual(len(parsed), len(texts))
+            for cur_text, cur_parsed in zip(texts, parsed):
+                true_parsed = parse_text(cur_text, self.nlp, self.morph)
+                self.assertIsInstance(cur_parsed, list)
+                self.assertEqual(len(cur_parsed), len(true_parsed))
+                for val, true_val in zip(cur_parsed, true_parsed):
+                    self.assertIsInstance(val, tuple)
+                    self.assertEqual(len(val), 3)
+                    self.assertEqual(val[0], true_val[0])
+                    self.assertEqual(val[1], true_val[1])
+                    self.assertIsInstance(val[2], Parse)
+                    self.assertEqual(val[2].tag, true_val[2].tag)
+                    self.assertEqual(val[2].normal_form, true_val[2].normal_form)
+
     def test_find_main_token_01(self):
         s = 'Новосибирский государственный университет'
         true_main_token = 2
@@ -125,6 +160,229 @@ class TestLinguisticUtils(unittest.TestCase):
         self.assertFalse(predicted_transformation[1])
         self.assertEqual(predicted_transformation[0], true_transformation)
 
+    def test_find_main_token_in_doc_01(self):
+        s = 'В Новосибирском государственном университете учится много студентов.'
+        true_main_token = 2
+        doc, tokens = parse_text_with_doc(s, self.nlp, self.morph)
+        self.assertEqual(len(doc), len(tokens))
+        res = find_main_token_in_doc(doc, 1, 4)
+        self.assertIsInstance(res, tuple)
+        self.assertEqual(len(res), 2)
+        self.assertIsInstance(res[0], int)
+        self.assertIsInstance(res[1], bool)
+        self.assertEqual(res[0], true_main_token)
+        self.assertTrue(res[1])
+
+    def test_find_main_token_in_doc_02(self):
+        s = 'В Новосибирском государственном университете учится много студентов.'
+        true_main_token = 0
+        doc, tokens = parse_text_with_doc(s, self.nlp, self.morph)
+        res = find_main_token_in_doc(doc, 4, 7)
+        self.assertIsInstance(res, tuple)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0], true_main_token)
+        self.assertFalse(res[1])
+
+    def test_inflect_subphrase_with_doc(self):
+        s = 'В Новосибирском государственном университете учится много студентов.'
+        true_transformation = 'Новосибирские государственные университеты'
+        doc, tokens = parse_text_with_doc(s, self.nlp, self.morph)
+        predicted_transformation = inflect_subphrase(s, tokens, 1, 4, None,
+                                                     'nomn', 'plur', doc)
+        self.assertIsInstance(predicted_transformation, tuple)
+        self.assertEqual(len(predicted_transformation), 2)
+        self.assertTrue(predicted_transformation[1])
+        self.assertEqual(predicted_transformation[0], true_transformation)
+
+
+class TestCachedMorphAnalyzer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.morph = MorphAnalyzer()
+
+    def test_find_best_parsing(self):
+        cached_morph = CachedMorphAnalyzer(self.morph, maxsize=16)
+        variant = cached_morph.find_best_parsing('стали', 'NOUN', 'gent', 'sing')
+        self.assertIsInstance(variant, Parse)
+        self.assertEqual(variant.normal_form, 'сталь')
+        self.assertEqual(cached_morph.hits, 0)
+        self.assertEqual(cached_morph.misses, 1)
+        variant = cached_morph.find_best_parsing('стали', 'NOUN', 'gent', 'sing')
+        self.assertEqual(variant.normal_form, 'сталь')
+        self.assertEqual(cached_morph.hits, 1)
+        self.assertEqual(cached_morph.misses, 1)
+        variant = cached_morph.find_best_parsing('стали', 'VERB', '', '')
+        self.assertEqual(variant.normal_form, 'стать')
+        self.assertEqual(cached_morph.hits, 1)
+        self.assertEqual(cached_morph.misses, 2)
+        info = cached_morph.cache_info()
+        self.assertEqual(info['parse_misses'], 1)
+        self.assertEqual(info['parse_hits'], 1)
+
+    def test_maxsize(self):
+        cached_morph = CachedMorphAnalyzer(self.morph, maxsize=2)
+        for word in ['мама', 'мыла', 'раму', 'мама']:
+            self.assertEqual(cached_morph.parse(word), self.morph.parse(word))
+        info = cached_morph.cache_info()
+        self.assertEqual(info['parse_size'], 2)
+        self.assertEqual(info['parse_hits'], 0)
+        self.assertEqual(info['parse_misses'], 4)
+        cached_morph.cache_clear()
+        self.assertEqual(cached_morph.cache_info()['parse_size'], 0)
+
+
+class TestInitializeNLP(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        nlp = spacy.blank('ru')
+        nlp.add_pipe('sentencizer')
+        nlp.add_pipe('attribute_ruler')
+        nlp.to_disk(cls.temp_dir.name)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.temp_dir.cleanup()
+
+    def test_list_nlp_components(self):
+        self.assertEqual(list_nlp_components(self.temp_dir.name), ['sentencizer', 'attribute_ruler'])
+
+    def test_components(self):
+        nlp, morph = initialize_nlp(components=['sentencizer'], model_name=self.temp_dir.name)
+        self.assertEqual(nlp.pipe_names, ['sentencizer'])
+        self.assertIsInstance(morph, CachedMorphAnalyzer)
+        nlp, morph = initialize_nlp(components=None, model_name=self.temp_dir.name, morph_cache_size=0)
+        self.assertEqual(nlp.pipe_names, ['sentencizer', 'attribute_ruler'])
+        self.assertIsInstance(morph, MorphAnalyzer)
+        with self.assertRaises(ValueError):
+            _ = initialize_nlp(components=['ner'], model_name=self.temp_dir.name)
+
+    def test_sharing(self):
+        nlp, morph = initialize_nlp(components=('sentencizer',), model_name=self.temp_dir.name)
+        other_nlp, other_morph = initialize_nlp(components=['sentencizer'], model_name=self.temp_dir.name)
+        self.assertIs(nlp, other_nlp)
+        self.assertIs(morph, other_morph)
+
+
+class TestTokenTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.nlp = spacy.blank('ru')
+        cls.morph = CachedMorphAnalyzer(MorphAnalyzer())
+
+    def setUp(self) -> None:
+        self.text = 'Мама мыла раму, а  папа мыл раму.\nМама устала.'
+        self.doc = self.nlp(self.text)
+
+    def test_tuple_view(self):
+        true_tokens = parse_doc(self.doc, self.morph)
+        table = parse_doc_as_table(self.doc, self.morph)
+        self.assertIsInstance(table, TokenTable)
+        self.assertEqual(len(table), len(true_tokens))
+        self.assertEqual(table.to_list(), true_tokens)
+        self.assertEqual([table[idx] for idx in range(len(table))], true_tokens)
+        self.assertEqual(table[-1], true_tokens[-1])
+        self.assertEqual(table[2:5], true_tokens[2:5])
+        with self.assertRaises(IndexError):
+            _ = table[len(table)]
+
+    def test_interning(self):
+        table = parse_doc_as_table(self.doc, self.morph)
+        self.assertEqual(len(table.parses), len(set(map(lambda it: it.text, self.doc))))
+        same_words = [token.i for token in self.doc if token.text == 'раму']
+        self.assertEqual(len(same_words), 2)
+        self.assertIs(table[same_words[0]][2], table[same_words[1]][2])
+
+    def test_find(self):
+        true_tokens = parse_doc(self.doc, self.morph)
+        table = TokenTable(true_tokens)
+        for char_idx in range(-1, len(self.text) + 2):
+            self.assertEqual(table.find(char_idx), find_token_by_character_index(true_tokens, char_idx))
+            self.assertEqual(find_token_by_character_index(table, char_idx), table.find(char_idx))
+
+    def test_empty(self):
+        table = TokenTable([])
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.find(0), -1)
+        self.assertEqual(table.to_list(), [])
+
+
+class TestInflectSubphrases(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.morph = CachedMorphAnalyzer(MorphAnalyzer())
+        # the parsed document is built by hand, so the test does not depend on the spaCy model
+        cls.doc = Doc(
+            spacy.blank('ru').vocab,
+            words=['Красная', 'машина', 'СТОИТ', 'у', 'Старого', 'дома', '.'],
+            spaces=[True, True, True, True, True, False, False],
+            pos=['ADJ', 'NOUN', 'VERB', 'ADP', 'ADJ', 'NOUN', 'PUNCT'],
+            heads=[1, 2, 2, 5, 5, 2, 2],
+            deps=['amod', 'nsubj', 'ROOT', 'case', 'amod', 'obl', 'punct'],
+            morphs=['Case=Nom|Number=Sing', 'Case=Nom|Number=Sing', '', '', 'Case=Gen|Number=Sing',
+                    'Case=Gen|Number=Sing', '']
+        )
+        cls.text = cls.doc.text
+        cls.tokens = parse_doc(cls.doc, cls.morph)
+
+    def test_inflect_subphrases(self):
+        requests = [(0, 2, 'datv', 'sing'), (4, 6, 'loct', 'sing'), (2, 3, 'datv', 'sing'), (0, 2, 'ablt', 'plur')]
+        res = inflect_subphrases(self.text, self.tokens, requests, None, self.doc)
+        self.assertEqual(res, [('Красной машине', True), ('Старом доме', True), ('СТОИТ', False),
+                               ('Красными машинами', True)])
+        self.assertEqual(inflect_subphrases(self.text, TokenTable(self.tokens), requests, None, self.doc), res)
+        for cur_request, cur_result in zip(requests, res):
+            self.assertEqual(
+                inflect_subphrase(self.text, self.tokens, cur_request[0], cur_request[1], None, cur_request[2],
+                                  cur_request[3], self.doc),
+                cur_result
+            )
+
+    def test_skip_errors(self):
+        requests = [(0, 2, 'gent', 'sing'), (4, 6, 'wrong', 'sing')]
+        with self.assertRaises(RuntimeError):
+            _ = inflect_subphrases(self.text, self.tokens, requests, None, self.doc)
+        res = inflect_subphrases(self.text, self.tokens, requests, None, self.doc, skip_errors=True)
+        self.assertEqual(res, [('Красной машины', True), ('Старого дома', False)])
+
+
+class TestInflectSubstitutions(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.morph = CachedMorphAnalyzer(MorphAnalyzer())
+        cls.doc = Doc(
+            spacy.blank('ru').vocab,
+            words=['Газета', 'пишет', ',', 'что', 'она', 'права', '.', 'Её', 'читают', 'о', 'ней', '.'],
+            spaces=[True, False, True, True, True, False, True, True, True, True, False, False],
+            pos=['NOUN', 'VERB', 'PUNCT', 'SCONJ', 'PRON', 'ADJ', 'PUNCT', 'DET', 'VERB', 'ADP', 'PRON', 'PUNCT'],
+            heads=[1, 1, 5, 5, 5, 1, 1, 8, 8, 10, 8, 8],
+            deps=['nsubj', 'ROOT', 'punct', 'mark', 'nsubj', 'ccomp', 'punct', 'obj', 'ROOT', 'case', 'obl', 'punct'],
+            morphs=['Case=Nom|Gender=Fem|Number=Sing', '', '', '', 'Case=Nom|Gender=Fem|Number=Sing', '', '',
+                    'Case=Acc|Poss=Yes', '', '', 'Case=Loc|Gender=Fem|Number=Sing', '']
+        )
+        cls.text = cls.doc.text
+
+    def make_substitutions(self, mentions):
+        substitutions = []
+        for cur_mention in mentions:
+            mention_start = self.text.find(cur_mention)
+            substitutions.append((mention_start, mention_start + len(cur_mention), -1, -1, 'Газета'))
+        return substitutions
+
+    def test_inflection(self):
+        substitutions = self.make_substitutions(['Газета', 'она', 'ней'])
+        self.assertEqual(inflect_substitutions(self.text, substitutions, None, self.morph, self.doc),
+                         'Газета пишет, что газета права. Её читают о газете.')
+
+    def test_possessive_mention(self):
+        substitutions = self.make_substitutions(['Газета', 'Её'])
+        self.assertIsNone(inflect_substitutions(self.text, substitutions, None, self.morph, self.doc))
+
+    def test_unaligned_mention(self):
+        substitutions = self.make_substitutions(['Газета', 'она'])
+        substitutions[1] = (substitutions[1][0], substitutions[1][1] - 1) + substitutions[1][2:]
+        self.assertIsNone(inflect_substitutions(self.text, substitutions, None, self.morph, self.doc))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,74 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    from metrics_utils.metrics_utils import RunMetrics
+except:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from metrics_utils.metrics_utils import RunMetrics
+
+
+class TestRunMetrics(unittest.TestCase):
+    def test_measure(self):
+        metrics = RunMetrics()
+        with metrics.measure('write'):
+            time.sleep(0.01)
+        metrics.add_time('write', 1.0)
+        self.assertGreater(metrics.stage_times['write'], 1.0)
+        self.assertEqual(metrics.stage_times['load'], 0.0)
+
+    def test_timed(self):
+        metrics = RunMetrics()
+
+        def generate():
+            for idx in range(3):
+                time.sleep(0.01)
+                yield idx
+
+        self.assertEqual(list(metrics.timed(generate(), 'load')), [0, 1, 2])
+        self.assertGreater(metrics.stage_times['load'], 0.03)
+
+    def test_summary(self):
+        metrics = RunMetrics()
+        metrics.increment('output_tokens', 10)
+        metrics.increment('output_tokens', 5)
+        metrics.add_time('generate', 3.0)
+        metrics.skip('wrong_bounds')
+        metrics.skip('wrong_bounds')
+        summary = metrics.summary()
+        self.assertEqual(summary['counters'], {'output_tokens': 15})
+        self.assertEqual(summary['skipped_samples'], {'wrong_bounds': 2})
+        self.assertAlmostEqual(summary['generated_tokens_per_generation_sec'], 5.0)
+        self.assertGreater(summary['peak_host_memory_bytes'], 0)
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_fname = os.path.join(temp_dir, 'metrics.json')
+            prometheus_fname = os.path.join(temp_dir, 'metrics.prom')
+            metrics = RunMetrics(json_fname, prometheus_fname)
+            metrics.increment('written_rows', 3)
+            metrics.skip('main_entity_not_found')
+            metrics.export()
+            with open(json_fname, mode='r', encoding='utf-8') as fp:
+                summary = json.load(fp)
+            with open(prometheus_fname, mode='r', encoding='utf-8') as fp:
+                lines = fp.read().split('\n')
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['metrics.json', 'metrics.prom'])
+        self.assertEqual(summary['counters'], {'written_rows': 3})
+        self.assertIn('prepare_dataset_events_total{event="written_rows"} 3', lines)
+        self.assertIn('prepare_dataset_skipped_samples_total{reason="main_entity_not_found"} 1', lines)
+        self.assertIn('# TYPE prepare_dataset_stage_seconds_total counter', lines)
+
+    def test_labels(self):
+        metrics = RunMetrics(labels={'shard': '1'})
+        metrics.skip('wrong_bounds')
+        lines = metrics.to_prometheus().split('\n')
+        self.assertIn('prepare_dataset_skipped_samples_total{shard="1",reason="wrong_bounds"} 1', lines)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
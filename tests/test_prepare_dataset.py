@@ -0,0 +1,433 @@
+import csv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import tempfile
+import threading
+import types
+import unittest
+import warnings
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+try:
+    from prepare_dataset import OpenAICorrectionBackend, CachedCorrectionBackend, prepare_messages
+    from prepare_dataset import encode_prompt_prefix
+    from prepare_dataset import BucketedCorrectionBackend, CorrectionBackend, schedule_batches
+    from prepare_dataset import WindowedCorrectionBackend, split_into_windows
+    from prepare_dataset import iterate_prepared_samples, make_worker_commands, remove_options
+    from prepare_dataset import find_draft, find_non_greedy_options, generate_with_prompt_lookup, write_dataset
+    from prepare_dataset import HFCorrectionBackend
+    from cache_utils.cache_utils import CorrectionCache
+    from io_utils.io_utils import CSVDatasetWriter, ParquetDatasetWriter, load_progress
+    from metrics_utils.metrics_utils import RunMetrics
+except:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from prepare_dataset import OpenAICorrectionBackend, CachedCorrectionBackend, prepare_messages
+    from prepare_dataset import encode_prompt_prefix
+    from prepare_dataset import BucketedCorrectionBackend, CorrectionBackend, schedule_batches
+    from prepare_dataset import WindowedCorrectionBackend, split_into_windows
+    from prepare_dataset import iterate_prepared_samples, make_worker_commands, remove_options
+    from prepare_dataset import find_draft, find_non_greedy_options, generate_with_prompt_lookup, write_dataset
+    from prepare_dataset import HFCorrectionBackend
+    from cache_utils.cache_utils import CorrectionCache
+    from io_utils.io_utils import CSVDatasetWriter, ParquetDatasetWriter, load_progress
+    from metrics_utils.metrics_utils import RunMetrics
+
+
+class UpperCaseBackend(CorrectionBackend):
+    def __init__(self, max_batches: int = -1):
+        self.batches = []
+        self.max_batches = max_batches
+
+    def correct(self, source_texts):
+        if len(self.batches) == self.max_batches:
+            raise RuntimeError('The backend is stopped.')
+        self.batches.append(source_texts)
+        return [it.upper() for it in source_texts]
+
+
+class AffineModel:
+    """ Fake language model, which predicts the next token by an affine function of the previous one. """
+
+    def __init__(self, vocab_size: int, eos_token_id: int, factor: int = 1, shift: int = 1):
+        self.vocab_size = vocab_size
+        self.factor = factor
+        self.shift = shift
+        self.generation_config = types.SimpleNamespace(eos_token_id=eos_token_id, do_sample=False)
+
+    def predict(self, token_id: int) -> int:
+        return (self.factor * token_id + self.shift) % self.vocab_size
+
+    def __call__(self, input_ids, past_key_values, use_cache, logits_to_keep):
+        past_key_values.n_tokens += input_ids.shape[1]
+        next_ids = (self.factor * input_ids[0, -logits_to_keep:] + self.shift) % self.vocab_size
+        return types.SimpleNamespace(logits=torch.nn.functional.one_hot(next_ids, self.vocab_size).float()[None])
+
+
+class LengthCache:
+    def __init__(self):
+        self.n_tokens = 0
+
+    def get_seq_length(self) -> int:
+        return self.n_tokens
+
+    def crop(self, tokens_to_remove: int):
+        if tokens_to_remove >= 0:
+            raise ValueError(f'Only a negative number of removed tokens is supported, got {tokens_to_remove}.')
+        self.n_tokens = max(0, self.n_tokens + tokens_to_remove)
+
+
+class ThinkingTokenizer:
+    """ Fake tokenizer with a chat template, which adds an empty thinking block to the final assistant message. """
+
+    def apply_chat_template(self, messages, tokenize, add_generation_prompt):
+        turns = []
+        for message_idx, message in enumerate(messages):
+            content = message['content']
+            if (message['role'] == 'assistant') and (message_idx == len(messages) - 1):
+                content = '<think></think>' + content
+            turns.append(f'<{message["role"]}>{content}</{message["role"]}>')
+        if add_generation_prompt:
+            turns.append('<assistant>')
+        return ''.join(turns)
+
+
+class TestPromptPrefix(unittest.TestCase):
+    def test_uncached_prefix(self):
+        with self.assertWarns(UserWarning):
+            self.assertIsNone(encode_prompt_prefix(ThinkingTokenizer(), None, 'cpu'))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        source_text = request['messages'][-1]['content']
+        with self.server.lock:
+            self.server.requests.append(request)
+            self.server.ports.add(self.client_address[1])
+            n_failures = self.server.failures.get(source_text, 0)
+            if n_failures > 0:
+                self.server.failures[source_text] = n_failures - 1
+        if n_failures > 0:
+            self.send_answer(503, {'error': 'The server is overloaded.'})
+        else:
+            self.send_answer(200, {'choices': [{'message': {'role': 'assistant', 'content': source_text.upper()}}]})
+
+    def send_answer(self, status_code: int, answer: dict):
+        data = json.dumps(answer, ensure_ascii=False).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestOpenAICorrectionBackend(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.ports = set()
+        self.server.failures = dict()
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_correct(self):
+        texts = [f'Текст номер {idx}.' for idx in range(10)]
+        backend = OpenAICorrectionBackend(self.base_url, 'stub', max_concurrency=2)
+        try:
+            res = backend.correct(texts)
+            self.assertEqual(backend.correct([]), [])
+            res_ = backend.correct(texts[0:2])
+        finally:
+            backend.close()
+        self.assertIsInstance(res, list)
+        self.assertEqual(res, [it.upper() for it in texts])
+        self.assertEqual(res_, res[0:2])
+        self.assertEqual(len(self.server.requests), 12)
+        self.assertEqual(self.server.requests[0]['model'], 'stub')
+        self.assertEqual(self.server.requests[0]['messages'][:-1], prepare_messages())
+        self.assertLessEqual(len(self.server.ports), 2)
+
+    def test_retries(self):
+        texts = ['Первый текст.', 'Второй текст.']
+        self.server.failures[texts[1]] = 2
+        backend = OpenAICorrectionBackend(self.base_url, 'stub', max_retries=2, backoff=0.01)
+        try:
+            res = backend.correct(texts)
+        finally:
+            backend.close()
+        self.assertEqual(res, [it.upper() for it in texts])
+        self.assertEqual(backend.n_retries, 2)
+        self.assertEqual(backend.n_requests, 4)
+
+    def test_failure(self):
+        texts = ['Первый текст.']
+        self.server.failures[texts[0]] = 3
+        backend = OpenAICorrectionBackend(self.base_url, 'stub', max_retries=2, backoff=0.01)
+        try:
+            with self.assertRaises(RuntimeError):
+                backend.correct(texts)
+        finally:
+            backend.close()
+
+    def test_cached_correct(self):
+        texts = ['Первый текст.', 'Второй текст.', 'Первый текст.']
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_fname = os.path.join(temp_dir, 'cache.sqlite')
+            backend = CachedCorrectionBackend(OpenAICorrectionBackend(self.base_url, 'stub'),
+                                              CorrectionCache(db_fname))
+            try:
+                res = backend.correct(texts)
+            finally:
+                backend.close()
+            self.assertEqual(res, [it.upper() for it in texts])
+            self.assertEqual(len(self.server.requests), 2)
+            backend = CachedCorrectionBackend(OpenAICorrectionBackend(self.base_url, 'stub'),
+                                              CorrectionCache(db_fname))
+            try:
+                res = backend.correct(texts + ['Третий текст.'])
+                self.assertEqual(backend.cache.hits, 3)
+                self.assertEqual(backend.cache.misses, 1)
+            finally:
+                backend.close()
+            self.assertEqual(res, [it.upper() for it in texts + ['Третий текст.']])
+            self.assertEqual(len(self.server.requests), 3)
+            backend = CachedCorrectionBackend(OpenAICorrectionBackend(self.base_url, 'another_stub'),
+                                              CorrectionCache(db_fname))
+            try:
+                backend.correct(texts[0:1])
+                self.assertEqual(backend.cache.hits, 0)
+            finally:
+                backend.close()
+            self.assertEqual(len(self.server.requests), 4)
+
+
+class TestBucketedCorrectionBackend(unittest.TestCase):
+    def test_schedule_batches(self):
+        self.assertEqual(schedule_batches([3, 10, 1, 9, 2], 2), [[1, 3], [0, 4], [2]])
+        self.assertEqual(schedule_batches([], 2), [])
+        with self.assertRaises(ValueError):
+            _ = schedule_batches([1, 2], 0)
+
+    def test_correct(self):
+        texts = ['а' * 3, 'б' * 10, 'в', 'г' * 9, 'д' * 2]
+        inner_backend = UpperCaseBackend()
+        backend = BucketedCorrectionBackend(inner_backend, 2)
+        res = backend.correct(texts)
+        self.assertEqual(res, [it.upper() for it in texts])
+        self.assertEqual(inner_backend.batches, [[texts[1], texts[3]], [texts[0], texts[4]], [texts[2]]])
+        self.assertEqual(backend.n_tokens, 25)
+        self.assertEqual(backend.n_padded_tokens, 27)
+        self.assertEqual(backend.n_unscheduled_padded_tokens, 40)
+        self.assertAlmostEqual(backend.padding_efficiency, 25 / 27)
+        self.assertAlmostEqual(backend.unscheduled_padding_efficiency, 25 / 40)
+
+
+class TestWindowedCorrectionBackend(unittest.TestCase):
+    def setUp(self) -> None:
+        self.text = ('Первый абзац. Второе предложение!\n\nВторой абзац очень длинный, и в нём много слов. '
+                     'Ещё одно. И ещё.\nСтрока.')
+
+    def test_split_into_windows_01(self):
+        windows, separators = split_into_windows(self.text, UpperCaseBackend().measure, 1000)
+        self.assertEqual(windows, [self.text])
+        self.assertEqual(separators, [])
+
+    def test_split_into_windows_02(self):
+        windows, separators = split_into_windows(self.text, UpperCaseBackend().measure, 40)
+        self.assertEqual(windows, ['Первый абзац. Второе предложение!', 'Второй абзац очень длинный, и в нём',
+                                   'много слов.', 'Ещё одно. И ещё.', 'Строка.'])
+        self.assertEqual(separators, ['\n\n', ' ', ' ', '\n'])
+
+    def test_split_into_windows_03(self):
+        for max_length in range(1, len(self.text) + 1):
+            windows, separators = split_into_windows(self.text, UpperCaseBackend().measure, max_length)
+            self.assertEqual(len(windows), len(separators) + 1)
+            restored_text = windows[0] + ''.join(map(lambda it: it[0] + it[1], zip(separators, windows[1:])))
+            self.assertEqual(restored_text, self.text)
+            for cur_window in windows:
+                if len(cur_window.split()) > 1:
+                    self.assertLessEqual(len(cur_window), max_length)
+
+    def test_correct(self):
+        texts = [self.text, 'Короткий текст.']
+        inner_backend = UpperCaseBackend()
+        backend = WindowedCorrectionBackend(inner_backend, 40, batch_size=2)
+        res = backend.correct(texts)
+        self.assertEqual(res, [it.upper() for it in texts])
+        self.assertEqual(backend.n_texts, 2)
+        self.assertEqual(backend.n_windows, 6)
+        self.assertEqual(list(map(len, inner_backend.batches)), [2, 2, 2])
+        self.assertEqual(backend.settings()['max_window_length'], 40)
+
+
+class TestWorkerCommands(unittest.TestCase):
+    def test_remove_options(self):
+        argv = ['-i', 'input', '--output=output', '--workers', '2', '--batch-size', '4']
+        self.assertEqual(remove_options(argv, ['-o', '--output', '--workers']), ['-i', 'input', '--batch-size', '4'])
+
+    def test_make_worker_commands(self):
+        argv = ['-i', 'input', '-o', 'output', '--workers', '2', '--devices', 'cuda:0,cuda:1', '--threads', '8',
+                '--prometheus-textfile', 'metrics.prom']
+        commands = make_worker_commands(argv, 'output-shards', ['cuda:0', 'cuda:1'], 0, 'metrics.prom')
+        self.assertEqual(len(commands), 2)
+        for shard_id, command in enumerate(commands):
+            self.assertEqual(command[0], sys.executable)
+            self.assertEqual(command[2:], [
+                '-i', 'input',
+                '--output', os.path.join('output-shards', f'shard-{shard_id:05d}-of-00002'),
+                '--num-shards', '2',
+                '--shard-id', str(shard_id),
+                '--device', f'cuda:{shard_id}',
+                '--prometheus-textfile', f'metrics-shard-{shard_id:05d}.prom'
+            ])
+        commands = make_worker_commands(argv, 'output-shards', ['cpu', 'cpu'], 4)
+        self.assertEqual(commands[1][-2:], ['--threads', '4'])
+
+    def test_shard_files(self):
+        dataset_name = os.path.join(os.path.dirname(__file__), 'testdata', 'dataset')
+        for shard_id in range(2):
+            metrics = RunMetrics()
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.assertEqual(list(iterate_prepared_samples(dataset_name, 1, metrics, 2, shard_id)), [])
+            # every shard reads only its own file, which has overlapped mentions
+            self.assertEqual(metrics.skipped, {'overlapped_mentions': 1})
+
+
+class TestPromptLookupDecoding(unittest.TestCase):
+    def test_find_draft(self):
+        source_ids = [1, 2, 3, 4, 2, 3, 5, 6]
+        self.assertEqual(find_draft(source_ids, [], 0, 3), ([1, 2, 3], 0))
+        self.assertEqual(find_draft(source_ids, [7, 2, 3], 0, 2), ([4, 2], 3))
+        self.assertEqual(find_draft(source_ids, [7, 2, 3], 4, 2), ([5, 6], 6))
+        self.assertEqual(find_draft(source_ids, [7, 8, 6], 4, 2), ([], 4))
+        self.assertEqual(find_draft(source_ids, [7, 2, 3], 4, 0), ([], 4))
+
+    def test_find_non_greedy_options(self):
+        generation_config = types.SimpleNamespace(eos_token_id=2, do_sample=False, num_beams=1, repetition_penalty=1.0,
+                                                  temperature=0.7, min_new_tokens=None)
+        self.assertEqual(find_non_greedy_options(generation_config), [])
+        model = types.SimpleNamespace(generation_config=generation_config)
+        self.assertEqual(HFCorrectionBackend(None, model, 'cpu', prompt_lookup_num_tokens=4).prompt_lookup_num_tokens,
+                         4)
+        generation_config.repetition_penalty = 1.05
+        generation_config.no_repeat_ngram_size = 3
+        self.assertEqual(find_non_greedy_options(generation_config), ['repetition_penalty', 'no_repeat_ngram_size'])
+        with self.assertRaises(ValueError):
+            HFCorrectionBackend(None, model, 'cpu', prompt_lookup_num_tokens=4)
+        self.assertEqual(HFCorrectionBackend(None, model, 'cpu').prompt_lookup_num_tokens, 0)
+
+    @unittest.skipIf(torch is None, 'The PyTorch package is not installed.')
+    def test_copying(self):
+        model = AffineModel(vocab_size=16, eos_token_id=12)
+        input_ids = torch.tensor([[5, 6, 7, 1]])
+        past_key_values = LengthCache()
+        output_ids, stats = generate_with_prompt_lookup(model, input_ids, list(range(2, 12)), max_new_tokens=20,
+                                                        num_draft_tokens=4, past_key_values=past_key_values)
+        self.assertEqual(output_ids.tolist(), [[5, 6, 7, 1] + list(range(2, 13))])
+        self.assertEqual(stats, {'decoding_steps': 3, 'draft_tokens': 8, 'accepted_draft_tokens': 8})
+        self.assertEqual(past_key_values.get_seq_length(), 4 + 10)
+        output_ids, stats = generate_with_prompt_lookup(model, input_ids, list(range(2, 12)), max_new_tokens=3,
+                                                        num_draft_tokens=4, past_key_values=LengthCache())
+        self.assertEqual(output_ids.tolist(), [[5, 6, 7, 1, 2, 3, 4]])
+        self.assertEqual(stats, {'decoding_steps': 1, 'draft_tokens': 2, 'accepted_draft_tokens': 2})
+
+    @unittest.skipIf(torch is None, 'The PyTorch package is not installed.')
+    def test_greedy_equivalence(self):
+        model = AffineModel(vocab_size=31, eos_token_id=30, factor=3, shift=2)
+        input_ids = torch.tensor([[4, 9, 1]])
+        for source_ids in [[5, 17, 22, 7, 23, 9, 29, 27], [5, 17, 22, 8, 26, 18, 25, 15, 16, 19], [3, 1, 4, 1, 5]]:
+            for max_new_tokens in [1, 5, 40]:
+                expected_ids = []
+                while (len(expected_ids) < max_new_tokens) and ((len(expected_ids) == 0) or (expected_ids[-1] != 30)):
+                    expected_ids.append(model.predict(expected_ids[-1] if (len(expected_ids) > 0) else 1))
+                past_key_values = LengthCache()
+                output_ids, stats = generate_with_prompt_lookup(model, input_ids, source_ids, max_new_tokens,
+                                                                num_draft_tokens=3, past_key_values=past_key_values)
+                self.assertEqual(output_ids.tolist(), [[4, 9, 1] + expected_ids])
+                self.assertEqual(stats['decoding_steps'] + stats['accepted_draft_tokens'], len(expected_ids))
+                self.assertLessEqual(stats['accepted_draft_tokens'], stats['draft_tokens'])
+                self.assertLessEqual(past_key_values.get_seq_length(), 3 + len(expected_ids))
+
+
+class TestWriteDataset(unittest.TestCase):
+    def setUp(self) -> None:
+        self.samples = [
+            (sample_idx, f'Газета пишет, что она права ({sample_idx}).',
+             f'Газета пишет, что Газета права ({sample_idx}).', [(0, 6, 0, 6, 'Газета')] * (1 + sample_idx % 2))
+            for sample_idx in range(5)
+        ]
+
+    def test_inflection(self):
+        def inflect(source_text, substitutions):
+            return source_text.replace('она', 'газета') if len(substitutions) > 1 else None
+
+        for pipelined in [False, True]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                backend = UpperCaseBackend()
+                metrics = RunMetrics()
+                progress = {'processed_samples': 0, 'n_rows': 0}
+                n_rows = write_dataset(iter(self.samples), len(self.samples), backend, CSVDatasetWriter(temp_dir),
+                                       os.path.join(temp_dir, 'progress.json'), progress, 2, pipelined,
+                                       metrics=metrics, inflect=inflect)
+                with open(os.path.join(temp_dir, 'train_data.csv'), mode='r', encoding='utf-8', newline='') as fp:
+                    rows = list(csv.DictReader(fp))
+            self.assertEqual(n_rows, 5)
+            self.assertEqual([it['text_without_coreference'] for it in rows], [
+                'ГАЗЕТА ПИШЕТ, ЧТО ГАЗЕТА ПРАВА (0).',
+                'Газета пишет, что газета права (1).',
+                'ГАЗЕТА ПИШЕТ, ЧТО ГАЗЕТА ПРАВА (2).',
+                'Газета пишет, что газета права (3).',
+                'ГАЗЕТА ПИШЕТ, ЧТО ГАЗЕТА ПРАВА (4).'
+            ])
+            self.assertEqual(sum(map(len, backend.batches)), 3)
+            self.assertEqual(metrics.counters['bypassed_samples'], 2)
+            self.assertEqual(metrics.counters['corrected_samples'], 3)
+
+    @unittest.skipIf(pyarrow is None, 'The pyarrow package is not installed.')
+    def test_parquet_resuming(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest_fname = os.path.join(temp_dir, 'progress.json')
+            progress = {'processed_samples': 0, 'n_rows': 0}
+            # the run is killed at the third batch, before any shard is written
+            with self.assertRaises(RuntimeError):
+                write_dataset(iter(self.samples), len(self.samples), UpperCaseBackend(max_batches=2),
+                              ParquetDatasetWriter(temp_dir, None, rows_per_shard=10), manifest_fname, progress, 2)
+            progress = load_progress(manifest_fname)
+            self.assertEqual(progress['processed_samples'], 4)
+            backend = UpperCaseBackend()
+            n_rows = write_dataset(iter(self.samples), len(self.samples), backend,
+                                   ParquetDatasetWriter(temp_dir, progress, rows_per_shard=10), manifest_fname,
+                                   progress, 2)
+            rows = pyarrow.parquet.read_table(os.path.join(temp_dir, 'train-00000.parquet')).to_pylist()
+        self.assertEqual(n_rows, 5)
+        self.assertEqual(backend.batches, [[self.samples[4][2]]])
+        self.assertEqual([it['sample_idx'] for it in rows], list(range(5)))
+        self.assertEqual([it['text_without_coreference'] for it in rows], [it[2].upper() for it in self.samples])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
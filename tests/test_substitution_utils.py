@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+
+try:
+    from substitution_utils.substitution_utils import select_main_entity, build_substitutions, apply_substitutions
+    from substitution_utils.substitution_utils import prepare_sample, prepare_sample_with_plan
+except:
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    from substitution_utils.substitution_utils import select_main_entity, build_substitutions, apply_substitutions
+    from substitution_utils.substitution_utils import prepare_sample, prepare_sample_with_plan
+
+
+class TestSubstitutionUtils(unittest.TestCase):
+    def setUp(self) -> None:
+        self.text = ' Газета Financial Times пишет о России. По мнению газеты, она развивается.\n\nИсточник: НТВ'
+        self.coreference_chains = [[(1, 23), (50, 56)], [(32, 38), (58, 61)]]
+
+    def test_select_main_entity_01(self):
+        self.assertEqual(select_main_entity(['газеты', 'Газета Financial Times', 'она']), 'Газета Financial Times')
+
+    def test_select_main_entity_02(self):
+        self.assertEqual(select_main_entity(['Российская Федерация', 'РФ', 'она']), 'РФ')
+
+    def test_build_substitutions_01(self):
+        res = build_substitutions(self.text, self.coreference_chains, 0)
+        self.assertIsInstance(res, tuple)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0], ' Газета Financial Times пишет о России. По мнению газеты, она развивается.')
+        self.assertEqual(res[1], [(1, 23, 'Газета Financial Times'), (32, 38, 'России'),
+                                  (50, 56, 'Газета Financial Times'), (58, 61, 'России')])
+
+    def test_build_substitutions_02(self):
+        reasons = []
+        with self.assertWarns(UserWarning):
+            res = build_substitutions(self.text, [[(1, 23), (90, 93)]], 0, reasons.append)
+        self.assertIsNone(res)
+        self.assertEqual(reasons, ['wrong_bounds'])
+
+    def test_build_substitutions_03(self):
+        reasons = []
+        self.assertIsNone(build_substitutions(self.text, [[(1, 23)]], 0, reasons.append))
+        self.assertEqual(reasons, ['single_mention_chain'])
+
+    def test_apply_substitutions(self):
+        res = apply_substitutions('Газета пишет, что она права.', [(0, 6, 'Газета'), (18, 21, 'Газета')])
+        self.assertIsInstance(res, tuple)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0], 'Газета пишет, что Газета права.')
+        self.assertEqual(res[1], [(0, 6), (18, 24)])
+
+    def test_prepare_sample_with_plan(self):
+        res = prepare_sample_with_plan(self.text, self.coreference_chains, 0)
+        self.assertIsInstance(res, tuple)
+        self.assertEqual(len(res), 3)
+        source_text, text_with_substitutions, plan = res
+        self.assertEqual(source_text, 'Газета Financial Times пишет о России. По мнению газеты, она развивается.')
+        self.assertEqual(text_with_substitutions, 'Газета Financial Times пишет о России. '
+                                                  'По мнению Газета Financial Times, России развивается.')
+        self.assertEqual(len(plan), 4)
+        for source_start, source_end, target_start, target_end, main_entity in plan:
+            self.assertEqual(text_with_substitutions[target_start:target_end], main_entity)
+            self.assertEqual(self.text[(source_start + 1):(source_end + 1)],
+                             source_text[source_start:source_end])
+        self.assertEqual(prepare_sample(self.text, self.coreference_chains, 0), res[0:2])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)